@@ -0,0 +1,351 @@
+"""Offline load test: runs the bot's real handlers against a fake Bot API and a temp SQLite file.
+
+Usage:
+    python bench.py --users 200 --messages 5 --broadcast-users 5000 --latency 0.02 --error-rate 0.01
+
+Phases:
+    relay        N users send text/photo/document/album messages (handle_user_message)
+    admin_reply  admins reply to every relayed ticket        (handle_admin_reply)
+    admin_edit   admins edit a share of those replies         (handle_admin_edit)
+    broadcast    /broadcast to a seeded user table            (broadcast engine)
+
+Reports updates/sec, p50/p99 handler latency, DB wait times and Bot API call counts.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+from functools import partial
+from urllib.parse import parse_qs
+
+# Point the bot at a throwaway database before main.py opens its global one
+TMP_DIR = tempfile.mkdtemp(prefix="relaybench-")
+OWN_DB = "DB_NAME" not in os.environ
+os.environ.setdefault("DB_NAME", os.path.join(TMP_DIR, "bench.db"))
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendVoice",
+                   "editMessageText", "editMessageCaption", "copyMessage"}
+OTHER_METHODS = {"getMe", "sendChatAction", "setMessageReaction", "setMyCommands",
+                 "setWebhook", "deleteWebhook", "answerCallbackQuery", "sendMediaGroup"}
+ADMIN_ID = 900000001
+
+
+# --------------------------------------------------------------------------------
+# 🧪 FAKE BOT API
+# --------------------------------------------------------------------------------
+class FakeBotAPI:
+    """Answers Bot API calls locally with configurable latency and injected 429s."""
+    def __init__(self, token, latency, jitter, error_rate, retry_after):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.message_ids = itertools.count(100000)
+        self.calls = Counter()
+        self.injected_429 = 0
+        self.admin_messages = []  # ids of messages posted to the admin group, i.e. ticket candidates
+        self.server = main.WebServer("127.0.0.1", 0)
+        for method in MESSAGE_METHODS | OTHER_METHODS:
+            self.server.route("POST", f"/bot{token}/{method}", partial(self.handle, method))
+
+    async def start(self):
+        await self.server.start()
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def handle(self, method, request):
+        self.calls[method] += 1
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = {k: v[0] for k, v in parse_qs(request.body.decode()).items()}
+        else:
+            params = {}
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method != "getMe" and random.random() < self.error_rate:
+            self.injected_429 += 1
+            return 429, "application/json", json.dumps({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return 200, "application/json", json.dumps({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self.message(params) for _ in media]
+        if method in MESSAGE_METHODS:
+            return self.message(params)
+        return True
+
+    def message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        message_id = int(params["message_id"]) if "message_id" in params else next(self.message_ids)
+        if chat_id == main.ADMIN_GROUP_ID and "message_id" not in params:
+            self.admin_messages.append(message_id)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "text": params.get("text", ""),
+        }
+
+
+# --------------------------------------------------------------------------------
+# 📨 SYNTHETIC UPDATES
+# --------------------------------------------------------------------------------
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+def user_message(user_id, kind):
+    user = {"id": user_id, "is_bot": False, "first_name": f"Student{user_id}", "username": f"s{user_id}"}
+    message = {"message_id": next(message_ids), "date": int(time.time()), "from": user,
+               "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]}}
+    n = next(update_ids)
+    if kind == "photo":
+        message["photo"] = [{"file_id": f"photo-{n}", "file_unique_id": f"uphoto-{n % 50}", "width": 800, "height": 600}]
+        message["caption"] = "screenshot of the error"
+    elif kind == "document":
+        message["document"] = {"file_id": f"doc-{n}", "file_unique_id": f"udoc-{n % 20}", "file_name": "form.pdf"}
+        message["caption"] = "my internship form"
+    else:
+        message["text"] = f"Question {n}: how do I submit my weekly report?"
+    return {"update_id": n, "message": message}
+
+def album_messages(user_id, size):
+    group_id = f"album-{next(update_ids)}"
+    updates = [user_message(user_id, "photo") for _ in range(size)]
+    for u in updates:
+        u["message"]["media_group_id"] = group_id
+        u["message"].pop("caption")
+    updates[0]["message"]["caption"] = "all pages of my form"
+    return updates
+
+def admin_message(text, reply_to=None, message_id=None, edited=False):
+    admin = {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"}
+    chat = {"id": main.ADMIN_GROUP_ID, "type": "supergroup", "title": "Support"}
+    message = {"message_id": message_id or next(message_ids), "date": int(time.time()), "from": admin, "chat": chat, "text": text}
+    if reply_to:
+        message["reply_to_message"] = {"message_id": reply_to, "date": int(time.time()), "chat": chat}
+    if edited:
+        message["edit_date"] = int(time.time())
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(update_ids), "edited_message" if edited else "message": message}
+
+
+# --------------------------------------------------------------------------------
+# ⏱️ MEASUREMENT
+# --------------------------------------------------------------------------------
+class TimedProcessor(main.ChatOrderedUpdateProcessor):
+    """Records how long each update's handlers ran."""
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.samples = []
+
+    async def process_update(self, update, coroutine):
+        async def _timed():
+            start = time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                self.samples.append(time.perf_counter() - start)
+        await super().process_update(update, _timed())
+
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def histogram_percentile(name, pct):
+    # Upper bucket bound containing the percentile (histograms are cumulative)
+    hist = main.metrics.histograms.get(main.metrics._key(name, None))
+    if not hist or not hist[2]: return 0.0
+    target = hist[2] * pct / 100
+    for bound, n in zip(main.LATENCY_BUCKETS, hist[0]):
+        if n >= target: return bound
+    return float("inf")
+
+async def run_phase(application, processor, name, updates):
+    processor.samples = []
+    errors_before = sum(v for (n, _), v in main.metrics.counters.items() if n == "bot_handler_errors_total")
+    start = time.perf_counter()
+    for data in updates:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    await application.update_queue.join()
+    await main.album_buffer.drain()
+    await main.outbox.drain()  # handlers only queue sends; the phase ends when they are delivered
+    elapsed = time.perf_counter() - start
+    errors = sum(v for (n, _), v in main.metrics.counters.items() if n == "bot_handler_errors_total") - errors_before
+    return {
+        "phase": name,
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(updates) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(processor.samples, 50) * 1000, 2),
+        "p99_ms": round(percentile(processor.samples, 99) * 1000, 2),
+        "handler_errors": errors,
+    }
+
+async def run_broadcast(application, processor, audience):
+    # Through the storage API so every backend is seeded the same way
+    for start in range(0, audience, 500):
+        await asyncio.gather(*(main.storage.create_user(5000000 + i, f"Member{i}", None)
+                               for i in range(start, min(start + 500, audience))))
+    main.broadcast_engine.progress_interval = 1.0
+
+    total_users = 0
+    async for user_ids in main.get_all_users_details():
+        total_users += len(user_ids)
+    start = time.perf_counter()
+    await run_phase(application, processor, "broadcast_command", [admin_message("/broadcast Bench announcement")])
+    while main.broadcast_engine.tasks:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    counts = await main.get_broadcast_counts(max(await asyncio.to_thread(
+        lambda: [r[0] for r in main.db.execute_read_all("SELECT id FROM broadcasts")])))
+    return {
+        "phase": "broadcast",
+        "updates": total_users,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(total_users / elapsed, 1) if elapsed else 0,
+        "sent": counts.get("SENT", 0),
+        "failed": counts.get("FAILED", 0),
+    }
+
+async def run(args):
+    api = FakeBotAPI(main.BOT_TOKEN, args.latency, args.jitter, args.error_rate, args.retry_after)
+    await api.start()
+    main.BOT_API_BASE_URL = api.base_url
+    processor = main.update_processor = TimedProcessor(args.concurrency)
+    main.album_buffer.window = args.album_window
+    main.storage = main.build_storage(args.storage)
+    # Fake API has no flood limits: lift the per-chat spacing, keep a global rate
+    main.outbox.limiter = main.broadcast_engine.limiter = main.RateLimiter(args.api_rate, 0.0)
+
+    application = main.build_application(webhook=True)
+    await application.initialize()
+    main.bot_state["application"] = application
+    await application.start()
+    for i in range(args.canned):
+        # Only weekly_report matches the bench questions; the rest are index noise
+        name = "weekly_report" if i == 0 else f"canned_{i}"
+        await main.canned.put({"name": name, "text": f"How to submit your weekly report #{i}" if i == 0 else f"Canned answer {i} about topic {i * 7}",
+                               "media_type": None, "file_unique_id": None, "file_id": None}, "bench")
+    await main.outbox.start(application.bot)
+
+    results = []
+    kinds = ["text"] * 6 + ["photo"] * 2 + ["document"] + ["album"] * args.albums
+    relay = []
+    for _ in range(args.messages):
+        for u in range(args.users):
+            kind = random.choice(kinds)
+            if kind == "album":
+                relay += album_messages(700000 + u, random.randint(2, 10))
+            else:
+                relay.append(user_message(700000 + u, kind))
+    results.append(await run_phase(application, processor, "relay", relay))
+
+    tickets = list(api.admin_messages)
+    replies = [admin_message(f"Answer for ticket {t}", reply_to=t) for t in tickets]
+    results.append(await run_phase(application, processor, "admin_reply", replies))
+
+    edits = [admin_message(u["message"]["text"] + " (edited)", reply_to=u["message"]["reply_to_message"]["message_id"],
+                           message_id=u["message"]["message_id"], edited=True)
+             for u in random.sample(replies, int(len(replies) * args.edit_share))]
+    results.append(await run_phase(application, processor, "admin_edit", edits))
+
+    if args.broadcast_users:
+        results.append(await run_broadcast(application, processor, args.broadcast_users))
+
+    await main.outbox.stop(main.OUTBOX_DRAIN_TIMEOUT)
+    await application.stop()
+    await application.shutdown()
+    await main.broadcast_engine.shutdown()
+    await api.server.stop()
+    main.storage.close()
+
+    pool = main.db.read_pool.metrics()
+    commits = main.metrics.counters.get(main.metrics._key("bot_db_commits_total", None), 0)
+    writes = main.metrics.counters.get(main.metrics._key("bot_db_writes_total", None), 0)
+    report = {
+        "config": vars(args),
+        "phases": results,
+        "db": {
+            "read_pool_waits": pool["waited"],
+            "read_pool_wait_max_ms": round(pool["wait_seconds_max"] * 1000, 2),
+            "read_pool_max_queue_depth": pool["max_queue_depth"],
+            "write_wait_p50_ms": histogram_percentile("bot_db_write_wait_seconds", 50) * 1000,
+            "write_wait_p99_ms": histogram_percentile("bot_db_write_wait_seconds", 99) * 1000,
+            "commits": commits,
+            "avg_writes_per_commit": round(writes / commits, 1) if commits else 0,
+        },
+        "bot_api": {"calls": dict(api.calls), "injected_429": api.injected_429},
+        "outbox": {key: sum(v for (n, _), v in main.metrics.counters.items() if n == f"bot_outbox_{key}_total")
+                   for key in ("sent", "retries", "dead")},
+        "cache": main.cache_stats(),
+    }
+    return report
+
+def print_report(report):
+    print("\n📊 Relay bot benchmark")
+    print(f"{'phase':<14}{'updates':>9}{'sec':>9}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for r in report["phases"]:
+        print(f"{r['phase']:<14}{r['updates']:>9}{r['seconds']:>9}{r['updates_per_sec']:>10}"
+              f"{r.get('p50_ms', '-'):>10}{r.get('p99_ms', '-'):>10}{r.get('handler_errors', r.get('failed', 0)):>8}")
+    print("\n🗄️ DB:", json.dumps(report["db"]))
+    print("🌐 Bot API:", json.dumps(report["bot_api"]))
+    print("📮 Outbox:", json.dumps(report["outbox"]))
+    print("🗃️ Cache:", json.dumps(report["cache"]))
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--albums", type=int, default=1, help="weight of albums among message kinds (0 disables)")
+    parser.add_argument("--album-window", type=float, default=main.ALBUM_WINDOW, help="album buffer window (s)")
+    parser.add_argument("--edit-share", type=float, default=0.2, help="share of admin replies that get edited")
+    parser.add_argument("--broadcast-users", type=int, default=2000, help="0 skips the broadcast phase")
+    parser.add_argument("--api-rate", type=float, default=1000, help="send rate limit for the bench (msgs/sec)")
+    parser.add_argument("--storage", choices=("sqlite", "sharded", "memory"), default="sqlite",
+                        help="backend for users/tickets (sharded uses STORAGE_SHARDS files)")
+    parser.add_argument("--canned", type=int, default=50, help="canned answers to seed (suggestions on relays)")
+    parser.add_argument("--concurrency", type=int, default=main.MAX_CONCURRENT_UPDATES)
+    parser.add_argument("--latency", type=float, default=0.02, help="fake Bot API base latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="extra random latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    main.db.close()
+    if OWN_DB:
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+    else:
+        os.rmdir(TMP_DIR)
+
+if __name__ == "__main__":
+    main_cli()
@@ -2,16 +2,37 @@ import logging
 import sqlite3
 import os
 import threading
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from pathlib import Path
 import time
 import asyncio
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import functools
+import itertools
+import hashlib
+import hmac
+import html
+import json
+import random
+import signal
+import re
+import secrets
 from datetime import datetime, timedelta
 from typing import Optional, Tuple, List
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReactionTypeEmoji, BotCommand, constants
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReactionTypeEmoji, BotCommand,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio,
+)
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -22,33 +43,355 @@ from telegram.ext import (
 # --------------------------------------------------------------------------------
 # ⚙️ SYSTEM CONFIGURATION
 # --------------------------------------------------------------------------------
-BOT_TOKEN = "8420582565:AAFNPu1P7Qp-sgtrGKaZlCFxNstShgwbilI"
+BOT_TOKEN = os.environ.get('BOT_TOKEN', "8420582565:AAFNPu1P7Qp-sgtrGKaZlCFxNstShgwbilI")
 ADMIN_GROUP_ID = -1003325498790
-DB_NAME = "relay_bot.db"
+DB_NAME = os.environ.get('DB_NAME', "relay_bot.db")
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL', "https://api.telegram.org/bot")
+
+# Outgoing rate limit shared by every sender (Telegram allows ~30 msg/sec globally, ~1 msg/sec per chat)
+API_RATE_PER_SEC = 25
+API_PER_CHAT_INTERVAL = 1.0
+
+# Broadcast tuning
+BROADCAST_CONCURRENCY = 20
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_PROGRESS_INTERVAL = 3.0
+
+# Outbox: relays and replies are queued in SQLite and sent by background workers
+OUTBOX_WORKERS = 8
+OUTBOX_MAX_ATTEMPTS = 8        # transient failures before a job is dead-lettered (flood-waits not counted)
+OUTBOX_BACKOFF_BASE = 1.0      # seconds; doubles per attempt, with +/-50% jitter
+OUTBOX_BACKOFF_MAX = 300
+OUTBOX_DRAIN_TIMEOUT = 10      # seconds to finish queued sends on shutdown
+DEAD_LETTER_PAGE_SIZE = 10
+
+# Write pipeline: one writer thread group-commits queued writes
+WRITE_BATCH_SIZE = 200
+WRITE_BATCH_WINDOW = 0.005  # seconds to wait for more writes before committing
+
+# Storage backend for users / tickets / reply tracking: "sqlite" (one file), "sharded" or "memory"
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', "sqlite")
+STORAGE_SHARDS = int(os.environ.get('STORAGE_SHARDS', 4))   # files for "sharded", split by user_id
+AUDIENCE_BATCH_SIZE = 1000     # user ids per batch when streaming a broadcast audience
+
+# Read pool: WAL lets these run alongside the writer
+READ_POOL_SIZE = 4
+READ_STATEMENT_CACHE = 256
+
+# Hot-path caches (size, TTL seconds)
+USER_CACHE_SIZE = 10000
+TICKET_CACHE_SIZE = 20000
+MEDIA_CACHE_SIZE = 20000
+CACHE_TTL = 3600
+
+# Ticket search (/search, /history)
+SEARCH_PAGE_SIZE = 5
+SEARCH_MIN_CHARS = 3           # trigram index needs at least 3 characters
+
+# Canned answers: suggested on relayed questions by trigram overlap
+CANNED_SUGGESTIONS = 3         # max suggestion buttons per relayed question
+CANNED_MIN_SCORE = 0.4         # share of the question's trigrams an answer must cover
+CANNED_NAME = re.compile(r"[\w-]{1,32}", re.ASCII)  # ASCII keeps "cn:<name>" within callback_data's 64 bytes
+CANNED_PICKER_MAX = 90         # buttons on the /canned picker, under Telegram's 100 per keyboard
+
+# Albums: items sharing a media_group_id are buffered, then relayed with one sendMediaGroup
+ALBUM_WINDOW = 1.0             # seconds of quiet after the last item before flushing
+ALBUM_MAX_ITEMS = 10           # Telegram's media group limit
+
+# Retention: how long rows live per table, and how gently they are pruned
+RETENTION = {
+    "message_map": timedelta(days=1),
+    "reply_tracking": timedelta(days=1),
+    "media_index": timedelta(days=1),  # same as message_map, so a duplicate hint never points at a pruned ticket
+    "broadcast_deliveries": timedelta(days=7),  # finished broadcasts only; a running one resumes from these rows
+}
+RETENTION_INTERVAL = 600       # seconds between passes
+RETENTION_BATCH_SIZE = 500     # max rows deleted per write transaction
+RETENTION_BATCH_TARGET = 0.05  # seconds a batch may hold the writer; batch size adapts to it
+RETENTION_VACUUM_PAGES = 200   # pages released per incremental_vacuum step
+RETENTION_STEP_PAUSE = 0.05    # seconds between batches, lets relay writes interleave
+
+# Instrumentation
+EXECUTOR_WORKERS = 32          # thread pool behind asyncio.to_thread (DB reads)
+POLL_STALE_AFTER = 90          # /healthz fails if getUpdates hasn't succeeded for this long
+
+# Web server (runs on the bot's event loop)
+HTTP_PORT = int(os.environ.get('PORT', 8080))
+HTTP_KEEPALIVE_TIMEOUT = 15    # idle seconds before a keep-alive connection is closed
+HTTP_REQUEST_TIMEOUT = 10      # seconds allowed to send headers + body
+HTTP_MAX_BODY = 1024 * 1024
+
+# Webhook mode (used instead of polling when WEBHOOK_URL is set)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')            # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = "/telegram/webhook"
+# Same default on every instance, so instances behind one load balancer agree
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = 40
+UPDATE_QUEUE_MAX = 1000        # bounded update queue = backpressure
+WEBHOOK_ENQUEUE_TIMEOUT = 2.0  # seconds to wait for queue room before answering 503
+
+# Update processing: chats run in parallel, each chat/ticket stays in order
+MAX_CONCURRENT_UPDATES = 64
+
+# --------------------------------------------------------------------------------
+# 📊 METRICS (Prometheus text format)
+# --------------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []  # callables yielding (name, labels, value) gauges at scrape time
+        self.last_success = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound: hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    @staticmethod
+    def _fmt(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lines.append(f"{name}{self._fmt(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            for bound, n in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._fmt(labels, [('le', bound)])} {n}")
+            lines.append(f"{name}_bucket{self._fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._fmt(labels)} {total}")
+            lines.append(f"{name}_count{self._fmt(labels)} {count}")
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} gauge"); typed.add(name)
+                    lines.append(f"{name}{self._fmt(sorted((labels or {}).items()))} {value}")
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=512)
+def query_label(query):
+    # "SELECT user_id FROM users WHERE ..." -> "SELECT users"
+    verb = query.split(None, 1)[0].upper()
+    match = _SQL_TABLE.search(query)
+    return f"{verb} {match.group(1)}" if match else verb
+
+def instrumented(handler):
+    # Counts calls/errors and records latency per handler
+    name = handler.__name__
+    @functools.wraps(handler)
+    async def _wrapped(update, context):
+        start = time.perf_counter()
+        metrics.inc("bot_handler_calls_total", {"handler": name})
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", {"handler": name})
+            raise
+        finally:
+            metrics.observe("bot_handler_latency_seconds", time.perf_counter() - start, {"handler": name})
+    return _wrapped
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and status per Bot API method."""
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_requests_total", {"method": api_method, "status": type(e).__name__})
+            raise
+        finally:
+            metrics.observe("bot_api_latency_seconds", time.perf_counter() - start, {"method": api_method})
+        metrics.inc("bot_api_requests_total", {"method": api_method, "status": code})
+        if code == 200:
+            metrics.last_success[api_method] = time.time()
+        return code, payload
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """Default executor for asyncio.to_thread that tracks queued and running jobs."""
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix="bot-io")
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self.stats_lock:
+            self.queued += 1
+        def _run():
+            with self.stats_lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.stats_lock:
+                    self.active -= 1
+        return super().submit(_run)
+
+io_executor = InstrumentedExecutor(EXECUTOR_WORKERS)
 
 # --------------------------------------------------------------------------------
 # 🛠️ HIGH-PERFORMANCE DATABASE MANAGER
 # --------------------------------------------------------------------------------
+class ReadPool:
+    """Bounded pool of read-only connections, each with its own statement cache."""
+    def __init__(self, db_name, size):
+        self.uri = Path(db_name).resolve().as_uri() + "?mode=ro"
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        # Metrics
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False, cached_statements=READ_STATEMENT_CACHE)
+        conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+        if create:
+            return self._connect()
+
+        start = time.monotonic()
+        conn = self.idle.get()
+        wait = time.monotonic() - start
+        with self.lock:
+            self.waiting -= 1
+            self.waited += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        with self.lock:
+            self.acquired += 1
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try: self.idle.get_nowait().close()
+            except queue.Empty: break
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "open": self.created,
+                "idle": self.idle.qsize(),
+                "queue_depth": self.waiting,
+                "max_queue_depth": self.max_waiting,
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_seconds_total": self.total_wait,
+                "wait_seconds_max": self.max_wait,
+            }
+
 class DatabaseManager:
     def __init__(self, db_name):
         self.db_name = db_name
         self.lock = threading.Lock()
         self.conn = None
         self.init_db()
+        self.read_pool = ReadPool(db_name, READ_POOL_SIZE)
+
+        # Single writer thread owns the write connection
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        # WAL Mode = Faster concurrency (Write-Ahead Logging)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
 
     def get_connection(self):
-        # Creates a persistent connection
+        # Creates a persistent connection (schema setup only)
         if self.conn is None:
-            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            # WAL Mode = Faster concurrency (Write-Ahead Logging)
-            self.conn.execute("PRAGMA journal_mode=WAL;") 
-            self.conn.execute("PRAGMA synchronous=NORMAL;")
+            self.conn = self._connect()
         return self.conn
 
     def init_db(self):
         with self.lock:
             conn = self.get_connection()
             c = conn.cursor()
+
+            # Incremental auto-vacuum lets retention hand pages back without a full VACUUM.
+            # Switching an existing file needs one rebuild, done here before the bot serves traffic.
+            if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                c.execute("VACUUM")
             
             # 1. Message Map
             c.execute('''CREATE TABLE IF NOT EXISTS message_map (
@@ -82,8 +425,31 @@ class DatabaseManager:
                 user_name TEXT
             )''')
 
+            # 4. Broadcasts (one row per /broadcast run)
+            c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                status TEXT DEFAULT 'RUNNING',
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                created_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )''')
+
+            # 5. Broadcast Deliveries (per-user state, makes broadcasts resumable)
+            c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'PENDING',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (broadcast_id, user_id)
+            )''')
+
             # Indices for speed
             c.execute("CREATE INDEX IF NOT EXISTS idx_msg_admin_id ON message_map(admin_message_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_bd_status ON broadcast_deliveries(broadcast_id, status)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_users_uid ON users(user_id)")
             
             # Migrations (Safe to run every time)
@@ -93,72 +459,973 @@ class DatabaseManager:
             except: pass
             try: c.execute("ALTER TABLE message_map ADD COLUMN answer_text TEXT")
             except: pass
-            
+            try:
+                c.execute("ALTER TABLE reply_tracking ADD COLUMN created_at TIMESTAMP")
+                # Existing rows start their retention window now
+                c.execute("UPDATE reply_tracking SET created_at=? WHERE created_at IS NULL", (datetime.now(),))
+            except: pass
+            c.execute("CREATE INDEX IF NOT EXISTS idx_msg_created ON message_map(created_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_rt_created ON reply_tracking(created_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_bd_updated ON broadcast_deliveries(updated_at)")
+            # Deliveries snapshotted before rows were stamped start their retention window now
+            c.execute("UPDATE broadcast_deliveries SET updated_at=? WHERE updated_at IS NULL", (datetime.now(),))
+
+            # 6. ID Sequences (atomic display_id allocation)
+            c.execute('''CREATE TABLE IF NOT EXISTS id_sequences (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )''')
+            self._migrate_display_ids(c)
+
+            # 7. Full-text index over questions/answers (kept in sync by triggers)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_msg_display ON message_map(display_id, id)")
+
+            # 8. Album tickets: every admin-side message of one album shares a ticket_id
+            try: c.execute("ALTER TABLE message_map ADD COLUMN ticket_id INTEGER")
+            except: pass
+            c.execute("CREATE INDEX IF NOT EXISTS idx_msg_ticket ON message_map(ticket_id)")
+            self._create_search_index(c)
+
+            # 9. Outbox (queued sends, deleted once delivered) and its dead-letter table
+            c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                kind TEXT,
+                payload TEXT,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                kind TEXT,
+                payload TEXT,
+                attempts INTEGER,
+                error TEXT,
+                created_at TIMESTAMP,
+                failed_at TIMESTAMP
+            )''')
+
+            # 10. Media index: one row per distinct file (file_unique_id is stable, file_id is reusable)
+            c.execute('''CREATE TABLE IF NOT EXISTS media_index (
+                file_unique_id TEXT PRIMARY KEY,
+                file_id TEXT,
+                media_type TEXT,
+                file_size INTEGER,
+                first_ticket INTEGER,
+                hits INTEGER DEFAULT 1,
+                created_at TIMESTAMP,
+                last_seen TIMESTAMP
+            )''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_media_created ON media_index(created_at)")
+
+            # 11. Canned answers (media is kept by file_unique_id so it resolves through media_index)
+            c.execute('''CREATE TABLE IF NOT EXISTS canned_answers (
+                name TEXT PRIMARY KEY,
+                text TEXT,
+                media_type TEXT,
+                file_unique_id TEXT,
+                file_id TEXT,
+                created_by TEXT,
+                created_at TIMESTAMP
+            )''')
+
             conn.commit()
 
-    def execute_write(self, query, params=()):
-        with self.lock:
-            conn = self.get_connection()
-            c = conn.cursor()
+    def _create_search_index(self, c):
+        exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='message_fts'").fetchone()
+        # Trigram tokenizer: Khmer has no spaces between words, so match substrings instead of words
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+            question_text, answer_text,
+            content='message_map', content_rowid='id', tokenize='trigram'
+        )''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS message_fts_ai AFTER INSERT ON message_map BEGIN
+            INSERT INTO message_fts(rowid, question_text, answer_text) VALUES (new.id, new.question_text, new.answer_text);
+        END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS message_fts_ad AFTER DELETE ON message_map BEGIN
+            INSERT INTO message_fts(message_fts, rowid, question_text, answer_text) VALUES ('delete', old.id, old.question_text, old.answer_text);
+        END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS message_fts_au AFTER UPDATE OF question_text, answer_text ON message_map BEGIN
+            INSERT INTO message_fts(message_fts, rowid, question_text, answer_text) VALUES ('delete', old.id, old.question_text, old.answer_text);
+            INSERT INTO message_fts(rowid, question_text, answer_text) VALUES (new.id, new.question_text, new.answer_text);
+        END''')
+        if not exists:
+            c.execute("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+
+    def _migrate_display_ids(self, c):
+        # One-time: repair duplicate DI-xxx ids left by the old COUNT(*) allocator, then lock it down
+        if c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_users_display_id'").fetchone():
+            return
+
+        max_suffix = c.execute("SELECT MAX(CAST(SUBSTR(display_id, 4) AS INTEGER)) FROM users WHERE display_id LIKE 'DI-%'").fetchone()[0] or 0
+        count = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        c.execute("INSERT OR IGNORE INTO id_sequences (name, value) VALUES ('display_id', ?)", (max(max_suffix, count),))
+
+        duplicates = c.execute('''SELECT user_id FROM users u
+            WHERE display_id IS NOT NULL AND EXISTS (
+                SELECT 1 FROM users o WHERE o.display_id = u.display_id
+                AND (o.joined_at < u.joined_at OR (o.joined_at IS u.joined_at AND o.rowid < u.rowid)))
+            ORDER BY joined_at, rowid''').fetchall()
+        for (user_id,) in duplicates:
+            display_id = self.next_display_id(c)
+            c.execute("UPDATE users SET display_id=? WHERE user_id=?", (display_id, user_id))
+            c.execute("UPDATE message_map SET display_id=? WHERE user_id=?", (display_id, user_id))
+        if duplicates:
+            print(f"🔧 Repaired {len(duplicates)} duplicate display IDs")
+
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_display_id ON users(display_id)")
+
+    @staticmethod
+    def next_display_id(c):
+        return f"DI-{DatabaseManager.next_sequence(c, 'display_id'):03d}"
+
+    @staticmethod
+    def next_sequence(c, name, count=1):
+        # Reserves count values and returns the last one
+        c.execute("UPDATE id_sequences SET value = value + ? WHERE name=?", (count, name))
+        return c.execute("SELECT value FROM id_sequences WHERE name=?", (name,)).fetchone()[0]
+
+    # ---------------- Write pipeline ----------------
+    def _writer_loop(self):
+        conn = self._connect()
+        conn.isolation_level = None  # explicit BEGIN/COMMIT so a whole batch is one commit
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._run_batch(conn, [req for req in batch if req is not None])
+            if stop: break
+        conn.close()
+
+    def _run_batch(self, conn, batch):
+        c = conn.cursor()
+        pending = []  # futures resolved only once their commit succeeded
+        for fn, future, transactional, submitted in batch:
+            # Caller gave up before we started: skip it. Once running it can't be cancelled.
+            if not future.set_running_or_notify_cancel():
+                continue
+            metrics.observe("bot_db_write_wait_seconds", time.perf_counter() - submitted)
+            if not transactional:
+                # e.g. VACUUM, which cannot run inside a transaction
+                self._commit(conn, pending)
+                pending = []
+                try: future.set_result(fn(c))
+                except Exception as e: future.set_exception(e)
+                continue
+
+            if not conn.in_transaction:
+                c.execute("BEGIN")
+            # Savepoint per request: one bad statement doesn't fail the whole batch
+            c.execute("SAVEPOINT req")
+            try:
+                with metrics.timer("bot_db_query_seconds", {"query": getattr(fn, "label", "transaction")}):
+                    result = fn(c)
+                c.execute("RELEASE req")
+                pending.append((future, result))
+            except Exception as e:
+                future.set_exception(e)
+                try:
+                    c.execute("ROLLBACK TO req")
+                    c.execute("RELEASE req")
+                except sqlite3.Error:
+                    conn.rollback()
+                    for f, _ in pending: f.set_exception(e)
+                    pending = []
+        self._commit(conn, pending)
+
+    def _commit(self, conn, pending):
+        try:
+            if conn.in_transaction:
+                with metrics.timer("bot_db_commit_seconds"):
+                    conn.execute("COMMIT")
+                metrics.inc("bot_db_commits_total")
+                metrics.inc("bot_db_writes_total", value=len(pending))
+        except Exception as e:
+            if conn.in_transaction: conn.rollback()
+            for f, _ in pending: f.set_exception(e)
+            return
+        for f, result in pending:
+            f.set_result(result)
+
+    def submit_write(self, fn, transactional=True) -> Future:
+        # Queues fn(cursor) for the writer thread; the future resolves after commit
+        future = Future()
+        self.write_queue.put((fn, future, transactional, time.perf_counter()))
+        return future
+
+    @staticmethod
+    def _statement(query, params):
+        def _run(c):
             c.execute(query, params)
-            conn.commit()
             return c.lastrowid
+        _run.label = query_label(query)
+        return _run
+
+    def execute_write(self, query, params=()):
+        return self.submit_write(self._statement(query, params)).result()
 
+    def execute_transaction(self, fn):
+        # Runs fn(cursor) atomically (inside the writer's current batch)
+        return self.submit_write(fn).result()
+
+    async def execute_write_async(self, query, params=()):
+        return await asyncio.wrap_future(self.submit_write(self._statement(query, params)))
+
+    async def execute_transaction_async(self, fn):
+        return await asyncio.wrap_future(self.submit_write(fn))
+
+    def close(self):
+        self.write_queue.put(None)
+        self.writer.join()
+        self.read_pool.close()
+
+    # ---------------- Reads ----------------
     def execute_read_one(self, query, params=()):
-        with self.lock:
-            conn = self.get_connection()
-            c = conn.cursor()
-            c.execute(query, params)
-            return c.fetchone()
+        with metrics.timer("bot_db_query_seconds", {"query": query_label(query)}):
+            with self.read_pool.connection() as conn:
+                return conn.execute(query, params).fetchone()
 
     def execute_read_all(self, query, params=()):
-        with self.lock:
-            conn = self.get_connection()
-            c = conn.cursor()
-            c.execute(query, params)
-            return c.fetchall()
+        with metrics.timer("bot_db_query_seconds", {"query": query_label(query)}):
+            with self.read_pool.connection() as conn:
+                return conn.execute(query, params).fetchall()
 
-    def vacuum_db(self):
-        with self.lock:
-            conn = self.get_connection()
-            conn.execute("VACUUM")
-            print("♻️ Database Optimized (VACUUM completed)")
 
 # Initialize Global DB
 db = DatabaseManager(DB_NAME)
 
+# --------------------------------------------------------------------------------
+# 🗄️ STORAGE BACKENDS (users, tickets, reply tracking)
+# --------------------------------------------------------------------------------
+TICKET_COLUMNS = "m.id, m.display_id, m.user_name, m.question_text, m.answer_text, m.status"
+
+class Storage(ABC):
+    """What the handlers need from users, message_map and reply_tracking.
+
+    Ticket rows are (id, display_id, user_name, question_text, answer_text, status), newest first.
+    Broadcasts, the outbox, media_index and canned answers always stay in the main database."""
+    databases = []  # DatabaseManagers holding these tables (retention and health checks walk them)
+
+    @abstractmethod
+    async def get_user(self, user_id):
+        """-> (display_id, first_name, username) or None"""
+
+    @abstractmethod
+    async def update_user_profile(self, user_id, first_name, username): ...
+
+    @abstractmethod
+    async def create_user(self, user_id, first_name, username):
+        """Registers the user if needed and returns their display_id."""
+
+    @abstractmethod
+    def iter_user_ids(self, batch_size):
+        """Async iterator of user_id lists, at most batch_size each."""
+
+    @abstractmethod
+    async def save_message(self, admin_msg_id, user_id, user_name, display_id, question):
+        """-> ticket id"""
+
+    @abstractmethod
+    async def save_album(self, admin_msg_ids, user_id, user_name, display_id, question):
+        """-> ticket id shared by every item"""
+
+    @abstractmethod
+    async def update_message_answer(self, admin_msg_id, answer, admin_name): ...
+
+    @abstractmethod
+    async def get_message_context(self, admin_msg_id):
+        """-> (user_id, user_name, display_id) or None"""
+
+    @abstractmethod
+    async def get_ticket_id(self, admin_msg_id): ...
+
+    @abstractmethod
+    async def save_reply_tracking(self, admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name): ...
+
+    @abstractmethod
+    async def get_reply_tracking(self, admin_msg_id):
+        """-> (user_chat_id, sent_msg_id, admin_name, user_name) or None"""
+
+    @abstractmethod
+    async def search_tickets(self, text, before_id, limit): ...
+
+    @abstractmethod
+    async def get_ticket_history(self, display_id, before_id, limit): ...
+
+    def close(self):
+        pass
+
+class SQLiteStorage(Storage):
+    """The tables of one DatabaseManager. On its own this is the classic single-file layout;
+    ShardedSQLiteStorage runs one per shard file."""
+    def __init__(self, database, sequence=None):
+        self.db = database
+        self.databases = [database]
+        self.sequence = sequence  # database owning id_sequences, when display and ticket ids are shared across files
+
+    async def get_user(self, user_id):
+        return await asyncio.to_thread(self.db.execute_read_one,
+            "SELECT display_id, first_name, username FROM users WHERE user_id=?", (user_id,))
+
+    async def update_user_profile(self, user_id, first_name, username):
+        await self.db.execute_write_async("UPDATE users SET first_name=?, username=? WHERE user_id=?", (first_name, username, user_id))
+
+    async def create_user(self, user_id, first_name, username):
+        # Shards share one sequence; an id allocated by a losing race is just a gap
+        allocated = None
+        if self.sequence is not None:
+            allocated = await self.sequence.execute_transaction_async(DatabaseManager.next_display_id)
+
+        # Check + allocate + insert in one writer transaction, so concurrent arrivals can't collide
+        def _ops(c):
+            row = c.execute("SELECT display_id FROM users WHERE user_id=?", (user_id,)).fetchone()
+            if row and row[0]:
+                c.execute("UPDATE users SET first_name=?, username=? WHERE user_id=?", (first_name, username, user_id))
+                return row[0]
+            display_id = allocated or DatabaseManager.next_display_id(c)
+            c.execute('''INSERT INTO users (user_id, first_name, username, display_id, joined_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET first_name=excluded.first_name, username=excluded.username, display_id=excluded.display_id''',
+                      (user_id, first_name, username, display_id, datetime.now()))
+            return display_id
+        return await self.db.execute_transaction_async(_ops)
+
+    async def iter_user_ids(self, batch_size):
+        # Keyset batches: each is a short read, so no snapshot is held open across the whole audience
+        last = -1
+        while True:
+            rows = await asyncio.to_thread(self.db.execute_read_all,
+                "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last, batch_size))
+            if not rows: return
+            yield [r[0] for r in rows]
+            last = rows[-1][0]
+
+    async def _ticket_ids(self, count):
+        # None lets AUTOINCREMENT pick; shards draw from one global sequence, so ids are unique
+        # across files and follow arrival order
+        if self.sequence is None: return [None] * count
+        last = await self.sequence.execute_transaction_async(lambda c: DatabaseManager.next_sequence(c, 'ticket_id', count))
+        return list(range(last - count + 1, last + 1))
+
+    async def save_message(self, admin_msg_id, user_id, user_name, display_id, question):
+        row_id, = await self._ticket_ids(1)
+        def _ops(c):
+            c.execute("INSERT INTO message_map (id, admin_message_id, user_id, user_name, display_id, question_text, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (row_id, admin_msg_id, user_id, user_name, display_id, question, datetime.now(), 'PENDING'))
+            return c.lastrowid
+        return await self.db.execute_transaction_async(_ops)
+
+    async def save_album(self, admin_msg_ids, user_id, user_name, display_id, question):
+        row_ids = await self._ticket_ids(len(admin_msg_ids))
+        # One transaction, one ticket: the first row's id becomes the album's ticket_id
+        def _ops(c):
+            ticket_id = None
+            for row_id, admin_msg_id in zip(row_ids, admin_msg_ids):
+                c.execute("INSERT INTO message_map (id, admin_message_id, user_id, user_name, display_id, question_text, created_at, status, ticket_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (row_id, admin_msg_id, user_id, user_name, display_id, question if ticket_id is None else "[Album]", datetime.now(), 'PENDING', ticket_id))
+                if ticket_id is None:
+                    ticket_id = c.lastrowid
+                    c.execute("UPDATE message_map SET ticket_id=? WHERE id=?", (ticket_id, ticket_id))
+            return ticket_id
+        return await self.db.execute_transaction_async(_ops)
+
+    async def update_message_answer(self, admin_msg_id, answer, admin_name):
+        # Answering any item of an album solves the whole ticket
+        await self.db.execute_write_async(
+            "UPDATE message_map SET status='SOLVED', answer_text=?, admin_responder=? WHERE admin_message_id=? "
+            "OR ticket_id = (SELECT ticket_id FROM message_map WHERE admin_message_id=? AND ticket_id IS NOT NULL)",
+            (answer, admin_name, admin_msg_id, admin_msg_id))
+
+    async def get_message_context(self, admin_msg_id):
+        return await asyncio.to_thread(self.db.execute_read_one,
+            "SELECT user_id, user_name, display_id FROM message_map WHERE admin_message_id=?", (admin_msg_id,))
+
+    async def get_ticket_id(self, admin_msg_id):
+        row = await asyncio.to_thread(self.db.execute_read_one,
+            "SELECT COALESCE(ticket_id, id) FROM message_map WHERE admin_message_id=?", (admin_msg_id,))
+        return row[0] if row else None
+
+    async def save_reply_tracking(self, admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name):
+        await self.db.execute_write_async(
+            "INSERT OR REPLACE INTO reply_tracking (admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name, datetime.now()))
+
+    async def get_reply_tracking(self, admin_msg_id):
+        return await asyncio.to_thread(self.db.execute_read_one,
+            "SELECT user_chat_id, sent_msg_id, admin_name, user_name FROM reply_tracking WHERE admin_msg_id=?", (admin_msg_id,))
+
+    async def search_tickets(self, text, before_id, limit):
+        # Quoted as one phrase so user input can't inject FTS5 query syntax
+        phrase = '"' + text.replace('"', '""') + '"'
+        return await asyncio.to_thread(self.db.execute_read_all,
+            f"SELECT {TICKET_COLUMNS} FROM message_fts JOIN message_map m ON m.id = message_fts.rowid "
+            "WHERE message_fts MATCH ? AND message_fts.rowid < ? ORDER BY message_fts.rowid DESC LIMIT ?",
+            (phrase, before_id, limit))
+
+    async def get_ticket_history(self, display_id, before_id, limit):
+        return await asyncio.to_thread(self.db.execute_read_all,
+            f"SELECT {TICKET_COLUMNS} FROM message_map m WHERE m.display_id=? AND m.id < ? ORDER BY m.id DESC LIMIT ?",
+            (display_id, before_id, limit))
+
+class ShardedSQLiteStorage(Storage):
+    """Users and their tickets spread over several SQLite files by user_id, each with its own writer.
+
+    Lookups by admin message id don't know the user, so they ask every shard (the caches in front
+    absorb most of them). Display and ticket ids come from the main database's id_sequences, so
+    they are unique across shards and ticket ids follow arrival order, which merged pages sort by."""
+    def __init__(self, path, count, sequence):
+        stem, ext = os.path.splitext(path)
+        self.parts = [SQLiteStorage(DatabaseManager(f"{stem}.shard{i}{ext}"), sequence) for i in range(count)]
+        self.databases = [part.db for part in self.parts]
+        # Start the ticket sequence above every id already in a shard
+        top = max(part.db.execute_read_one("SELECT COALESCE(MAX(id), 0) FROM message_map")[0] for part in self.parts)
+        sequence.execute_write("INSERT INTO id_sequences (name, value) VALUES ('ticket_id', ?) "
+                               "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)", (top,))
+
+    def part(self, user_id):
+        return self.parts[user_id % len(self.parts)]
+
+    async def _first(self, method, *args):
+        for result in await asyncio.gather(*(getattr(part, method)(*args) for part in self.parts)):
+            if result is not None: return result
+        return None
+
+    async def _merged(self, method, *args, limit):
+        rows = [row for rows in await asyncio.gather(*(getattr(part, method)(*args, limit) for part in self.parts)) for row in rows]
+        return sorted(rows, key=lambda row: row[0], reverse=True)[:limit]
+
+    async def get_user(self, user_id):
+        return await self.part(user_id).get_user(user_id)
+
+    async def update_user_profile(self, user_id, first_name, username):
+        await self.part(user_id).update_user_profile(user_id, first_name, username)
+
+    async def create_user(self, user_id, first_name, username):
+        return await self.part(user_id).create_user(user_id, first_name, username)
+
+    async def iter_user_ids(self, batch_size):
+        for part in self.parts:
+            async for user_ids in part.iter_user_ids(batch_size):
+                yield user_ids
+
+    async def save_message(self, admin_msg_id, user_id, user_name, display_id, question):
+        return await self.part(user_id).save_message(admin_msg_id, user_id, user_name, display_id, question)
+
+    async def save_album(self, admin_msg_ids, user_id, user_name, display_id, question):
+        return await self.part(user_id).save_album(admin_msg_ids, user_id, user_name, display_id, question)
+
+    async def update_message_answer(self, admin_msg_id, answer, admin_name):
+        # A miss is an indexed no-op, cheaper than finding the owning shard first
+        await asyncio.gather(*(part.update_message_answer(admin_msg_id, answer, admin_name) for part in self.parts))
+
+    async def get_message_context(self, admin_msg_id):
+        return await self._first("get_message_context", admin_msg_id)
+
+    async def get_ticket_id(self, admin_msg_id):
+        return await self._first("get_ticket_id", admin_msg_id)
+
+    async def save_reply_tracking(self, admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name):
+        await self.part(user_chat_id).save_reply_tracking(admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name)
+
+    async def get_reply_tracking(self, admin_msg_id):
+        return await self._first("get_reply_tracking", admin_msg_id)
+
+    async def search_tickets(self, text, before_id, limit):
+        return await self._merged("search_tickets", text, before_id, limit=limit)
+
+    async def get_ticket_history(self, display_id, before_id, limit):
+        return await self._merged("get_ticket_history", display_id, before_id, limit=limit)
+
+    def close(self):
+        for database in self.databases:
+            database.close()
+
+class MemoryStorage(Storage):
+    """Dicts instead of SQLite, for tests and benchmarks. Nothing persists and retention doesn't apply."""
+    def __init__(self):
+        self.users = {}       # user_id -> (display_id, first_name, username)
+        self.tickets = {}     # id -> row dict
+        self.by_admin_msg = {}  # admin_message_id -> id
+        self.albums = {}      # ticket_id -> ids of its rows
+        self.tracking = {}    # admin_msg_id -> (user_chat_id, sent_msg_id, admin_name, user_name)
+        self.ticket_ids = itertools.count(1)
+        self.display_ids = itertools.count(1)
+
+    async def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def update_user_profile(self, user_id, first_name, username):
+        self.users[user_id] = (self.users[user_id][0], first_name, username)
+
+    async def create_user(self, user_id, first_name, username):
+        existing = self.users.get(user_id)
+        display_id = existing[0] if existing else f"DI-{next(self.display_ids):03d}"
+        self.users[user_id] = (display_id, first_name, username)
+        return display_id
+
+    async def iter_user_ids(self, batch_size):
+        user_ids = sorted(self.users)
+        for start in range(0, len(user_ids), batch_size):
+            yield user_ids[start:start + batch_size]
+
+    def _insert(self, admin_msg_id, user_id, user_name, display_id, question, ticket_id=None):
+        row_id = next(self.ticket_ids)
+        self.tickets[row_id] = {"id": row_id, "display_id": display_id, "user_id": user_id, "user_name": user_name,
+                                "question_text": question, "answer_text": None, "status": "PENDING", "ticket_id": ticket_id}
+        self.by_admin_msg[admin_msg_id] = row_id
+        return row_id
+
+    async def save_message(self, admin_msg_id, user_id, user_name, display_id, question):
+        return self._insert(admin_msg_id, user_id, user_name, display_id, question)
+
+    async def save_album(self, admin_msg_ids, user_id, user_name, display_id, question):
+        ticket_id = None
+        for admin_msg_id in admin_msg_ids:
+            row_id = self._insert(admin_msg_id, user_id, user_name, display_id, question if ticket_id is None else "[Album]", ticket_id)
+            ticket_id = ticket_id or row_id
+            self.tickets[row_id]["ticket_id"] = ticket_id
+            self.albums.setdefault(ticket_id, []).append(row_id)
+        return ticket_id
+
+    async def update_message_answer(self, admin_msg_id, answer, admin_name):
+        row_id = self.by_admin_msg.get(admin_msg_id)
+        if row_id is None: return
+        for rid in self.albums.get(self.tickets[row_id]["ticket_id"], [row_id]):
+            self.tickets[rid].update(status="SOLVED", answer_text=answer, admin_responder=admin_name)
+
+    async def get_message_context(self, admin_msg_id):
+        row = self.tickets.get(self.by_admin_msg.get(admin_msg_id))
+        return (row["user_id"], row["user_name"], row["display_id"]) if row else None
+
+    async def get_ticket_id(self, admin_msg_id):
+        row = self.tickets.get(self.by_admin_msg.get(admin_msg_id))
+        return (row["ticket_id"] or row["id"]) if row else None
+
+    async def save_reply_tracking(self, admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name):
+        self.tracking[admin_msg_id] = (user_chat_id, sent_msg_id, admin_name, user_name)
+
+    async def get_reply_tracking(self, admin_msg_id):
+        return self.tracking.get(admin_msg_id)
+
+    def _scan(self, match, before_id, limit):
+        rows = []
+        for row_id in sorted(self.tickets, reverse=True):
+            row = self.tickets[row_id]
+            if row_id < before_id and match(row):
+                rows.append((row_id, row["display_id"], row["user_name"], row["question_text"], row["answer_text"], row["status"]))
+                if len(rows) == limit: break
+        return rows
+
+    async def search_tickets(self, text, before_id, limit):
+        needle = text.lower()
+        return self._scan(lambda r: needle in (r["question_text"] or "").lower() or needle in (r["answer_text"] or "").lower(),
+                          before_id, limit)
+
+    async def get_ticket_history(self, display_id, before_id, limit):
+        return self._scan(lambda r: r["display_id"] == display_id, before_id, limit)
+
+def build_storage(backend):
+    if backend == "sharded":
+        # Shards start empty and nothing copies rows over, so refuse rather than hide existing data
+        for table in ("users", "message_map"):
+            if db.execute_read_one(f"SELECT 1 FROM {table} LIMIT 1"):
+                raise RuntimeError(f"{DB_NAME} still holds {table} rows; move them into the shard files "
+                                   f"or keep STORAGE_BACKEND=sqlite (sharded storage does not migrate them)")
+        return ShardedSQLiteStorage(DB_NAME, STORAGE_SHARDS, sequence=db)
+    if backend == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(db)
+
+storage = build_storage(STORAGE_BACKEND)
+
 # --------------------------------------------------------------------------------
 # 🧹 AUTO CLEANUP TASK (Background Thread)
 # --------------------------------------------------------------------------------
+class RetentionEngine:
+    """Prunes expired rows in small indexed batches and releases pages incrementally."""
+    # table -> (key used to target each batch, timestamp the retention window applies to)
+    TABLES = {"message_map": ("id", "created_at"), "reply_tracking": ("admin_msg_id", "created_at"),
+              "media_index": ("file_unique_id", "created_at"), "broadcast_deliveries": ("rowid", "updated_at")}
+    # Only rows matching these are pruned once expired
+    FILTERS = {"broadcast_deliveries": "broadcast_id IN (SELECT id FROM broadcasts WHERE status='DONE')"}
+
+    def __init__(self, database, retention, batch_size, vacuum_pages, step_pause):
+        self.db = database
+        self.retention = retention
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.step_pause = step_pause
+
+    def prune_table(self, table, cutoff):
+        key, stamp = self.TABLES[table]
+        condition = f"{stamp} < ?" + (f" AND {self.FILTERS[table]}" if table in self.FILTERS else "")
+        query = (f"DELETE FROM {table} WHERE {key} IN "
+                 f"(SELECT {key} FROM {table} WHERE {condition} ORDER BY {stamp} LIMIT ?)")
+        deleted, size = 0, self.batch_size
+        while True:
+            # Each batch is its own write request, so relay writes interleave with it
+            start = time.perf_counter()
+            n = self.db.submit_write(lambda c: c.execute(query, (cutoff, size)).rowcount).result()
+            elapsed = time.perf_counter() - start
+            deleted += n
+            if n < size: return deleted
+            # FTS triggers make deletes costly: keep each batch near the target writer hold time
+            size = max(10, min(self.batch_size, int(size * RETENTION_BATCH_TARGET / max(elapsed, 0.001))))
+            time.sleep(self.step_pause)
+
+    def reclaim_pages(self):
+        freed = 0
+        while True:
+            before = self.db.execute_read_one("PRAGMA freelist_count")[0]
+            if not before: return freed
+            self.db.submit_write(lambda c: c.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall(),
+                                 transactional=False).result()
+            after = self.db.execute_read_one("PRAGMA freelist_count")[0]
+            freed += before - after
+            if after >= before: return freed
+            time.sleep(self.step_pause)
+
+    def run_pass(self):
+        now = datetime.now()
+        report = {table: self.prune_table(table, now - window) for table, window in self.retention.items()}
+        if report.get("message_map"):
+            # Fold the delete markers into the index so searches stay fast after pruning
+            self.db.execute_write("INSERT INTO message_fts(message_fts, rank) VALUES ('merge', 500)")
+        report["pages"] = self.reclaim_pages()
+        # Keep the WAL file from growing between passes
+        self.db.submit_write(lambda c: c.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall(), transactional=False).result()
+        return report
+
+# One engine per database file: the main one plus any shard files of the storage backend
+retention_engines = [RetentionEngine(database, RETENTION, RETENTION_BATCH_SIZE, RETENTION_VACUUM_PAGES, RETENTION_STEP_PAUSE)
+                     for database in dict.fromkeys([db] + storage.databases)]
+
 def auto_cleanup_task():
     while True:
         try:
-            time.sleep(3600) # 1 Hour
-            
-            cutoff_time = datetime.now() - timedelta(days=1)
-            
-            # Delete old messages
-            db.execute_write("DELETE FROM message_map WHERE created_at < ?", (cutoff_time,))
-            
-            # Optimize Storage
-            db.vacuum_db()
-            
+            time.sleep(RETENTION_INTERVAL)
+            reports = [engine.run_pass() for engine in retention_engines]
+            if any(r["media_index"] or r["message_map"] for r in reports):
+                # Cached entries may point at pruned tickets; the table is the source of truth
+                media_cache.clear()
+            rows = ", ".join(f"{t}={sum(r[t] for r in reports)}" for t in RETENTION)
+            print(f"♻️ Retention pass: {rows} rows deleted, {sum(r['pages'] for r in reports)} pages reclaimed")
         except Exception as e:
             print(f"⚠️ Cleanup Error: {e}")
 
 # --------------------------------------------------------------------------------
-# 🌐 FAKE WEB SERVER
+# 🌐 WEB SERVER (asyncio, health + metrics)
+# --------------------------------------------------------------------------------
+bot_state = {"application": None, "started_at": time.time()}
+
+def collect_runtime_gauges():
+    application = bot_state["application"]
+    if application is not None:
+        yield "bot_update_queue_size", None, application.update_queue.qsize()
+    with io_executor.stats_lock:
+        yield "bot_executor_max_workers", None, io_executor._max_workers
+        yield "bot_executor_active", None, io_executor.active
+        yield "bot_executor_queued", None, io_executor.queued
+    yield "bot_db_write_queue_size", None, sum(d.write_queue.qsize() for d in dict.fromkeys([db] + storage.databases))
+    for key, value in db.read_pool.metrics().items():
+        yield f"bot_db_read_pool_{key}", None, value
+    for cache, stats in cache_stats().items():
+        for key, value in stats.items():
+            yield f"bot_cache_{key}", {"cache": cache}, value
+    yield "bot_broadcasts_running", None, len(broadcast_engine.tasks)
+    yield "bot_outbox_pending", None, outbox.pending
+    yield "bot_outbox_lanes", None, len(outbox.lanes)
+    yield "bot_uptime_seconds", None, time.time() - bot_state["started_at"]
+
+metrics.collectors.append(collect_runtime_gauges)
+
+async def check_health():
+    # Returns (healthy, reason)
+    try:
+        await asyncio.to_thread(db.execute_read_one, "SELECT 1")
+    except Exception as e:
+        return False, f"db read failed: {e}"
+    if not all(d.writer.is_alive() for d in [db] + storage.databases):
+        return False, "db writer thread is dead"
+    application = bot_state["application"]
+    if application is None or not application.running:
+        return False, "application not running"
+    if application.updater and application.updater.running:
+        last_poll = metrics.last_success.get("getUpdates")
+        if last_poll is None or time.time() - last_poll > POLL_STALE_AFTER:
+            return False, "polling loop stalled"
+    return True, "ok"
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+                408: "Request Timeout", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class HTTPRequest:
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+class WebServer:
+    """Minimal HTTP/1.1 server on asyncio streams: concurrent connections, keep-alive and timeouts."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}  # (method, path) -> async handler(request) -> (status, content_type, body)
+        self.server = None
+        self.connections = set()
+        self.tasks = set()
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server is None: return
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        # Let open connections notice the close and finish on their own
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=1)
+        await self.server.wait_closed()
+        self.server = None
+
+    async def _read_request(self, reader, request_line):
+        method, path, version = request_line.decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > HTTP_MAX_BODY:
+            raise OverflowError
+        body = await reader.readexactly(length) if length else b""
+        return HTTPRequest(method, path.split("?", 1)[0], version, headers, body)
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader, request_line), HTTP_REQUEST_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self._respond(writer, 408, "text/plain", "timeout", False)
+                    break
+                except OverflowError:
+                    await self._respond(writer, 413, "text/plain", "too large", False)
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    await self._respond(writer, 400, "text/plain", "bad request", False)
+                    break
+
+                keep_alive = (request.version == "HTTP/1.1" and request.headers.get("connection", "").lower() != "close") \
+                    or request.headers.get("connection", "").lower() == "keep-alive"
+                status, ctype, body = await self._dispatch(request)
+                await self._respond(writer, status, ctype, body, keep_alive, head=request.method == "HEAD")
+                if not keep_alive: break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            self.tasks.discard(task)
+            writer.close()
+
+    async def _dispatch(self, request):
+        method = "GET" if request.method == "HEAD" else request.method
+        handler = self.routes.get((method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return 405, "text/plain", "method not allowed"
+            return 404, "text/plain", "not found"
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Web handler error on {request.path}: {e}")
+            return 500, "text/plain", "internal error"
+
+    async def _respond(self, writer, status, ctype, body, keep_alive, head=False):
+        payload = body if isinstance(body, bytes) else body.encode()
+        head_lines = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}",
+            f"Content-Type: {ctype}",
+            f"Content-Length: {len(payload)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if keep_alive:
+            head_lines.append(f"Keep-Alive: timeout={HTTP_KEEPALIVE_TIMEOUT}")
+        writer.write(("\r\n".join(head_lines) + "\r\n\r\n").encode("latin-1") + (b"" if head else payload))
+        await writer.drain()
+
+async def index_endpoint(request):
+    return 200, "text/plain", "Bot is active."
+
+async def healthz_endpoint(request):
+    healthy, reason = await check_health()
+    return (200 if healthy else 503), "text/plain", reason
+
+async def metrics_endpoint(request):
+    return 200, "text/plain; version=0.0.4", metrics.render()
+
+web_server = WebServer("0.0.0.0", HTTP_PORT)
+web_server.route("GET", "/", index_endpoint)
+web_server.route("GET", "/healthz", healthz_endpoint)
+web_server.route("GET", "/metrics", metrics_endpoint)
+
+# --------------------------------------------------------------------------------
+# 📥 WEBHOOK INGESTION
 # --------------------------------------------------------------------------------
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is active.")
+class WebhookReceiver:
+    """Verifies Telegram's secret header and feeds updates into the Application's queue."""
+    def __init__(self, secret):
+        self.secret = secret
+        self.accepting = True
+
+    async def handle(self, request):
+        application = bot_state["application"]
+        if not self.accepting or application is None:
+            # Telegram re-delivers on non-2xx, so nothing is lost while we drain
+            return 503, "text/plain", "shutting down"
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, self.secret):
+            metrics.inc("bot_webhook_requests_total", {"result": "unauthorized"})
+            return 401, "text/plain", "unauthorized"
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError):
+            metrics.inc("bot_webhook_requests_total", {"result": "bad_request"})
+            return 400, "text/plain", "bad update"
+        if update_processor.pending >= UPDATE_QUEUE_MAX:
+            # Concurrent processing empties the queue at once, so count running updates too
+            metrics.inc("bot_webhook_requests_total", {"result": "backpressure"})
+            return 503, "text/plain", "busy"
+        try:
+            await asyncio.wait_for(application.update_queue.put(update), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.inc("bot_webhook_requests_total", {"result": "backpressure"})
+            return 503, "text/plain", "busy"
+        metrics.inc("bot_webhook_requests_total", {"result": "accepted"})
+        return 200, "text/plain", "ok"
+
+webhook_receiver = WebhookReceiver(WEBHOOK_SECRET)
+web_server.route("POST", WEBHOOK_PATH, webhook_receiver.handle)
+
+async def run_webhook(application: Application) -> None:
+    # Manual lifecycle: run_polling() would normally call post_init/post_shutdown for us
+    await application.initialize()
+    await post_init(application)
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    await application.start()
+    print(f"🔗 Webhook mode: receiving updates on {WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Drain: refuse new deliveries, then let stop() finish every queued/in-flight update
+    webhook_receiver.accepting = False
+    print("⏳ Draining pending updates...")
+    await application.stop()
+    await post_stop(application)
+    await application.shutdown()
+    await post_shutdown(application)
+
+# --------------------------------------------------------------------------------
+# 🔀 UPDATE PROCESSOR (parallel across chats, ordered within a chat/ticket)
+# --------------------------------------------------------------------------------
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}    # ordering key -> asyncio.Lock (FIFO, so arrival order is kept)
+        self.lengths = {}  # ordering key -> updates waiting or running
+        self.pending = 0
+
+    @staticmethod
+    def ordering_key(update):
+        if not isinstance(update, Update):
+            return "global"
+        chat = update.effective_chat
+        message = update.effective_message
+        # Admin group: order per ticket, so a reply and its later edit never swap
+        if chat and chat.id == ADMIN_GROUP_ID and message and message.reply_to_message:
+            return f"ticket:{message.reply_to_message.message_id}"
+        if chat:
+            return f"chat:{chat.id}"
+        if update.effective_user:
+            return f"user:{update.effective_user.id}"
+        return "global"
+
+    async def process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.lengths[key] = self.lengths.get(key, 0) + 1
+        self.pending += 1
+        started = False
+        try:
+            # Take the chat's turn first, then a global slot, so waiting chats don't hog slots
+            async with lock:
+                async with self._semaphore:
+                    started = True
+                    await coroutine
+        finally:
+            if not started:
+                coroutine.close()
+            self.pending -= 1
+            self.lengths[key] -= 1
+            if not self.lengths[key]:
+                del self.lengths[key]
+                del self.locks[key]
 
-def start_web_server():
-    port = int(os.environ.get('PORT', 8080))
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    server.serve_forever()
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def queue_lengths(self, top=None):
+        ordered = sorted(self.lengths.items(), key=lambda kv: kv[1], reverse=True)
+        return dict(ordered[:top] if top else ordered)
+
+update_processor = ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+
+def collect_processor_gauges():
+    yield "bot_updates_in_flight", None, update_processor.pending
+    yield "bot_chat_queues_active", None, len(update_processor.lengths)
+    for key, length in update_processor.queue_lengths(top=10).items():
+        yield "bot_chat_queue_length", {"key": key}, length
+
+metrics.collectors.append(collect_processor_gauges)
 
 # --------------------------------------------------------------------------------
 # 🇰🇭 LANGUAGE PACK
@@ -172,6 +1439,11 @@ LANG = {
         "🛠 <b>មជ្ឈមណ្ឌលបញ្ជា</b>\n"
         "───────────────\n"
         "• <code>/broadcast [msg]</code> : ផ្ញើសារជូនដំណឹងទៅកាន់អ្នកទាំងអស់គ្នា\n"
+        "• <code>/search [ពាក្យ]</code> : ស្វែងរកសំណួរ និងចម្លើយចាស់ៗ\n"
+        "• <code>/history [DI-xxx]</code> : មើលប្រវត្តិសំណួររបស់និស្សិតម្នាក់\n"
+        "• <code>/canned</code> : ចម្លើយស្រាប់ៗ (reply លើសំណួរ ដើម្បីផ្ញើ)\n"
+        "• <code>/deadletters</code> : មើលសារដែលផ្ញើមិនចេញ\n"
+        "• <code>/replay [id|all]</code> : ផ្ញើសារដែលបរាជ័យម្តងទៀត\n"
         "• <code>/help</code> : បង្ហាញបញ្ជីនេះម្តងទៀត\n\n"
         "ℹ️ <i>ទិន្នន័យចាស់ៗនឹងត្រូវលុបចោលដោយស្វ័យប្រវត្តិដើម្បីសន្សំទំហំផ្ទុក។</i>"
     ),
@@ -194,52 +1466,779 @@ LANG = {
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --------------------------------------------------------------------------------
+# 🗃️ CACHE LAYER (LRU + TTL, write-through)
+# --------------------------------------------------------------------------------
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None: del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+user_cache = LRUCache(USER_CACHE_SIZE, CACHE_TTL)          # user_id -> (display_id, first_name, username)
+ticket_cache = LRUCache(TICKET_CACHE_SIZE, CACHE_TTL)      # admin_message_id -> (user_id, user_name, display_id)
+tracking_cache = LRUCache(TICKET_CACHE_SIZE, CACHE_TTL)    # admin_msg_id -> (user_chat_id, sent_msg_id, admin_name, user_name)
+media_cache = LRUCache(MEDIA_CACHE_SIZE, CACHE_TTL)        # file_unique_id -> (file_id, media_type, file_size, first_ticket)
+
+def cache_stats():
+    return {"users": user_cache.stats(), "message_map": ticket_cache.stats(), "reply_tracking": tracking_cache.stats(),
+            "media_index": media_cache.stats()}
+
 # --------------------------------------------------------------------------------
 # 🧠 ASYNC DATABASE HELPERS (NON-BLOCKING)
 # --------------------------------------------------------------------------------
 async def get_or_create_user(user):
-    def _ops():
-        row = db.execute_read_one("SELECT display_id FROM users WHERE user_id=?", (user.id,))
+    profile = (user.first_name, user.username)
+    cached = user_cache.get(user.id)
+    if cached is None:
+        row = await storage.get_user(user.id)
         if row and row[0]:
-            display_id = row[0]
-            db.execute_write("UPDATE users SET first_name=?, username=? WHERE user_id=?", (user.first_name, user.username, user.id))
-        else:
-            count = db.execute_read_one("SELECT COUNT(*) FROM users")[0]
-            display_id = f"DI-{count + 1:03d}"
-            db.execute_write("INSERT OR REPLACE INTO users (user_id, first_name, username, display_id, joined_at) VALUES (?, ?, ?, ?, ?)",
-                             (user.id, user.first_name, user.username, display_id, datetime.now()))
-        return display_id
-    return await asyncio.to_thread(_ops)
+            cached = (row[0], row[1], row[2])
+            user_cache.set(user.id, cached)
+
+    if cached:
+        # Only touch the DB when the profile actually changed
+        if cached[1:] != profile:
+            await storage.update_user_profile(user.id, user.first_name, user.username)
+            user_cache.set(user.id, (cached[0],) + profile)
+        return cached[0]
 
-async def get_all_users_details():
-    return await asyncio.to_thread(db.execute_read_all, "SELECT user_id FROM users")
+    display_id = await storage.create_user(user.id, user.first_name, user.username)
+    user_cache.set(user.id, (display_id,) + profile)
+    return display_id
+
+async def get_all_users_details(batch_size=AUDIENCE_BATCH_SIZE):
+    # Streams user ids in batches instead of loading the whole table
+    async for user_ids in storage.iter_user_ids(batch_size):
+        yield user_ids
 
 async def save_message(admin_msg_id, user_id, user_name, display_id, question):
-    await asyncio.to_thread(db.execute_write, 
-        "INSERT INTO message_map (admin_message_id, user_id, user_name, display_id, question_text, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (admin_msg_id, user_id, user_name, display_id, question, datetime.now(), 'PENDING'))
+    ticket_id = await storage.save_message(admin_msg_id, user_id, user_name, display_id, question)
+    ticket_cache.set(admin_msg_id, (user_id, user_name, display_id))
+    return ticket_id
+
+async def save_album(admin_msg_ids, user_id, user_name, display_id, question):
+    ticket_id = await storage.save_album(admin_msg_ids, user_id, user_name, display_id, question)
+    for admin_msg_id in admin_msg_ids:
+        ticket_cache.set(admin_msg_id, (user_id, user_name, display_id))
+    return ticket_id
 
 async def update_message_answer(admin_msg_id, answer, admin_name):
-    await asyncio.to_thread(db.execute_write,
-        "UPDATE message_map SET status='SOLVED', answer_text=?, admin_responder=? WHERE admin_message_id=?",
-        (answer, admin_name, admin_msg_id))
+    await storage.update_message_answer(admin_msg_id, answer, admin_name)
 
 async def get_message_context(admin_msg_id):
-    return await asyncio.to_thread(db.execute_read_one,
-        "SELECT user_id, user_name, display_id FROM message_map WHERE admin_message_id=?", (admin_msg_id,))
+    mapping = ticket_cache.get(admin_msg_id)
+    if mapping is None:
+        mapping = await storage.get_message_context(admin_msg_id)
+        if mapping: ticket_cache.set(admin_msg_id, tuple(mapping))
+    return mapping
 
 async def save_reply_tracking(admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name):
-    await asyncio.to_thread(db.execute_write,
-        "INSERT OR REPLACE INTO reply_tracking (admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name) VALUES (?, ?, ?, ?, ?)",
-        (admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name))
+    await storage.save_reply_tracking(admin_msg_id, user_chat_id, sent_msg_id, admin_name, user_name)
+    tracking_cache.set(admin_msg_id, (user_chat_id, sent_msg_id, admin_name, user_name))
 
 async def get_reply_tracking(admin_msg_id):
+    tracking = tracking_cache.get(admin_msg_id)
+    if tracking is None:
+        tracking = await storage.get_reply_tracking(admin_msg_id)
+        if tracking: tracking_cache.set(admin_msg_id, tuple(tracking))
+    return tracking
+
+async def create_broadcast(text, status_chat_id, status_message_id):
+    broadcast_id = await db.execute_write_async(
+        "INSERT INTO broadcasts (text, status, status_chat_id, status_message_id, created_at) VALUES (?, 'PREPARING', ?, ?, ?)",
+        (text, status_chat_id, status_message_id, datetime.now()))
+    await snapshot_audience(broadcast_id)
+    return broadcast_id
+
+async def snapshot_audience(broadcast_id):
+    # The audience is copied before sending so the run is resumable; until it is complete the
+    # broadcast stays PREPARING, and INSERT OR IGNORE lets a restarted snapshot pick up where it stopped
+    async for user_ids in get_all_users_details():
+        await db.execute_transaction_async(lambda c, user_ids=user_ids: c.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status, updated_at) VALUES (?, ?, 'PENDING', ?)",
+            [(broadcast_id, uid, datetime.now()) for uid in user_ids]))
+    await db.execute_write_async("UPDATE broadcasts SET status='RUNNING' WHERE id=?", (broadcast_id,))
+
+async def get_broadcast(broadcast_id):
     return await asyncio.to_thread(db.execute_read_one,
-        "SELECT user_chat_id, sent_msg_id, admin_name, user_name FROM reply_tracking WHERE admin_msg_id=?", (admin_msg_id,))
+        "SELECT text, status_chat_id, status_message_id FROM broadcasts WHERE id=?", (broadcast_id,))
+
+async def get_unfinished_broadcasts():
+    return await asyncio.to_thread(db.execute_read_all, "SELECT id, status FROM broadcasts WHERE status IN ('PREPARING', 'RUNNING')")
+
+async def get_pending_deliveries(broadcast_id):
+    rows = await asyncio.to_thread(db.execute_read_all,
+        "SELECT user_id FROM broadcast_deliveries WHERE broadcast_id=? AND status='PENDING'", (broadcast_id,))
+    return [r[0] for r in rows]
+
+async def get_broadcast_counts(broadcast_id):
+    rows = await asyncio.to_thread(db.execute_read_all,
+        "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id=? GROUP BY status", (broadcast_id,))
+    return dict(rows)
+
+async def mark_delivery(broadcast_id, user_id, status, attempts, error=None):
+    await db.execute_write_async(
+        "UPDATE broadcast_deliveries SET status=?, attempts=?, error=?, updated_at=? WHERE broadcast_id=? AND user_id=?",
+        (status, attempts, error, datetime.now(), broadcast_id, user_id))
+
+async def finish_broadcast(broadcast_id):
+    await db.execute_write_async(
+        "UPDATE broadcasts SET status='DONE', finished_at=? WHERE id=?", (datetime.now(), broadcast_id))
+
+async def add_outbox_job(chat_id, kind, payload):
+    def _ops(c):
+        c.execute("INSERT INTO outbox (chat_id, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                  (chat_id, kind, json.dumps(payload), datetime.now()))
+        return c.lastrowid
+    return await db.execute_transaction_async(_ops)
+
+async def get_outbox_jobs():
+    rows = await asyncio.to_thread(db.execute_read_all,
+        "SELECT id, chat_id, kind, payload, attempts FROM outbox ORDER BY id")
+    return [{"id": r[0], "chat_id": r[1], "kind": r[2], "payload": json.loads(r[3]), "attempts": r[4]} for r in rows]
+
+async def delete_outbox_job(job_id):
+    await db.execute_write_async("DELETE FROM outbox WHERE id=?", (job_id,))
+
+async def record_outbox_attempt(job_id, attempts, error):
+    await db.execute_write_async("UPDATE outbox SET attempts=?, last_error=? WHERE id=?", (attempts, error, job_id))
+
+async def dead_letter_job(job_id, attempts, error):
+    # Move, not copy: the row leaves the outbox in the same transaction
+    def _ops(c):
+        c.execute("INSERT INTO dead_letters (chat_id, kind, payload, attempts, error, created_at, failed_at) "
+                  "SELECT chat_id, kind, payload, ?, ?, created_at, ? FROM outbox WHERE id=?",
+                  (attempts, error, datetime.now(), job_id))
+        dead_id = c.lastrowid
+        c.execute("DELETE FROM outbox WHERE id=?", (job_id,))
+        return dead_id
+    return await db.execute_transaction_async(_ops)
+
+async def get_dead_letters(limit):
+    return await asyncio.to_thread(db.execute_read_all,
+        "SELECT id, chat_id, kind, attempts, error, failed_at FROM dead_letters ORDER BY id DESC LIMIT ?", (limit,))
+
+async def requeue_dead_letters(dead_id=None):
+    # dead_id=None replays everything; returns the new outbox jobs in order
+    def _ops(c):
+        where, params = ("WHERE id=?", (dead_id,)) if dead_id is not None else ("", ())
+        rows = c.execute(f"SELECT id, chat_id, kind, payload FROM dead_letters {where} ORDER BY id", params).fetchall()
+        jobs = []
+        for row_id, chat_id, kind, payload in rows:
+            c.execute("INSERT INTO outbox (chat_id, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                      (chat_id, kind, payload, datetime.now()))
+            jobs.append({"id": c.lastrowid, "chat_id": chat_id, "kind": kind, "payload": json.loads(payload), "attempts": 0})
+            c.execute("DELETE FROM dead_letters WHERE id=?", (row_id,))
+        return jobs
+    return await db.execute_transaction_async(_ops)
+
+CANNED_COLUMNS = ("name", "text", "media_type", "file_unique_id", "file_id")
+
+async def get_canned_answers():
+    rows = await asyncio.to_thread(db.execute_read_all, f"SELECT {', '.join(CANNED_COLUMNS)} FROM canned_answers")
+    return [dict(zip(CANNED_COLUMNS, row)) for row in rows]
+
+async def save_canned_answer(answer, created_by):
+    await db.execute_write_async(
+        "INSERT OR REPLACE INTO canned_answers (name, text, media_type, file_unique_id, file_id, created_by, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        tuple(answer[k] for k in CANNED_COLUMNS) + (created_by, datetime.now()))
+
+async def delete_canned_answer(name):
+    await db.execute_write_async("DELETE FROM canned_answers WHERE name=?", (name,))
+
+MEDIA_FIELDS = ("photo", "document", "video", "voice", "audio")
+
+def media_of(message):
+    # The attachment of a message as a JSON-safe dict, or None for plain text
+    for media_type in MEDIA_FIELDS:
+        media = getattr(message, media_type)
+        if media:
+            if media_type == "photo": media = media[-1]  # largest size
+            return {"unique_id": media.file_unique_id, "file_id": media.file_id, "type": media_type, "size": media.file_size}
+    return None
+
+async def get_cached_media(file_unique_id):
+    entry = media_cache.get(file_unique_id)
+    if entry is None:
+        entry = await asyncio.to_thread(db.execute_read_one,
+            "SELECT file_id, media_type, file_size, first_ticket FROM media_index WHERE file_unique_id=?", (file_unique_id,))
+        if entry: media_cache.set(file_unique_id, tuple(entry))
+    return entry
+
+async def index_media(attachments, ticket_id=None, answered_msg_id=None):
+    # First ticket wins; repeats refresh file_id, count the hit, and fill in a ticket if there was none
+    # (e.g. a file first indexed by /canned add).
+    # Admin attachments pass the ticket they answered instead of a ticket of their own.
+    if ticket_id is None and answered_msg_id is not None:
+        ticket_id = await storage.get_ticket_id(answered_msg_id)
+
+    def _ops(c):
+        now = datetime.now()
+        return [(m["unique_id"], c.execute('''INSERT INTO media_index
+                (file_unique_id, file_id, media_type, file_size, first_ticket, hits, created_at, last_seen)
+                VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT(file_unique_id) DO UPDATE SET file_id=excluded.file_id, hits=hits+1, last_seen=excluded.last_seen,
+                    first_ticket=COALESCE(media_index.first_ticket, excluded.first_ticket)
+                RETURNING file_id, media_type, file_size, first_ticket''',
+                (m["unique_id"], m["file_id"], m["type"], m["size"], ticket_id, now, now)).fetchone())
+                for m in attachments]
+    for unique_id, entry in await db.execute_transaction_async(_ops):
+        media_cache.set(unique_id, tuple(entry))
+
+async def search_tickets(text, before_id, limit):
+    return await storage.search_tickets(text, before_id, limit)
+
+async def get_ticket_history(display_id, before_id, limit):
+    return await storage.get_ticket_history(display_id, before_id, limit)
+
+# --------------------------------------------------------------------------------
+# 💬 TEMPLATES & CANNED ANSWERS
+# --------------------------------------------------------------------------------
+class Templates:
+    """LANG split once into static pieces; per message only the variable parts are joined."""
+    def __init__(self, lang):
+        self.reply_prefix = f"{lang['reply_header']}\n───────────────\n<b>ឆ្លើយតប :</b> "
+        self.footer_head, self.footer_tail = lang["reply_footer"].split("{name}")
+        self.relay_prefix = "👤 <b>ឈ្មោះ:</b> "
+        self.relay_rule = "\n───────────────\n"
+
+    def reply(self, body, user_name):
+        return "".join((self.reply_prefix, body, self.footer_head, user_name, self.footer_tail))
+
+    def relay_header(self, user_name):
+        return "".join((self.relay_prefix, user_name, self.relay_rule))
+
+templates = Templates(LANG)
+
+def trigrams(text):
+    # Character trigrams work for Khmer, which has no spaces between words
+    text = " ".join((text or "").lower().split())
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class CannedAnswers:
+    """Admin-defined answers, held in memory with an inverted trigram index for suggestions."""
+    def __init__(self, limit, min_score):
+        self.limit = limit
+        self.min_score = min_score
+        self.answers = {}  # name -> answer dict (CANNED_COLUMNS)
+        self.index = {}    # trigram -> set of names
+
+    async def load(self):
+        for answer in await get_canned_answers():
+            self._add(answer)
+
+    async def put(self, answer, created_by):
+        await save_canned_answer(answer, created_by)
+        self._remove(answer["name"])
+        self._add(answer)
+
+    async def delete(self, name):
+        await delete_canned_answer(name)
+        return self._remove(name)
+
+    def _add(self, answer):
+        self.answers[answer["name"]] = answer
+        for gram in self._grams(answer):
+            self.index.setdefault(gram, set()).add(answer["name"])
+
+    def _remove(self, name):
+        answer = self.answers.pop(name, None)
+        if answer is None: return False
+        for gram in self._grams(answer):
+            names = self.index[gram]
+            names.discard(name)
+            if not names: del self.index[gram]
+        return True
+
+    @staticmethod
+    def _grams(answer):
+        return trigrams(f"{answer['name'].replace('_', ' ')} {answer['text'] or ''}")
+
+    def suggest(self, text):
+        grams = trigrams(text)
+        if not grams or not self.index: return []
+        scores = Counter()
+        for gram in grams:
+            scores.update(self.index.get(gram, ()))
+        return [name for name, n in scores.most_common(self.limit) if n / len(grams) >= self.min_score]
+
+    async def reply_params(self, answer, user_name):
+        # Media goes out by file_id: the freshest one from media_index, else the one saved with the answer
+        body = templates.reply(answer["text"] or "", user_name)
+        if not answer["media_type"]:
+            return "send_message", {"text": body, "parse_mode": ParseMode.HTML}
+        cached = await get_cached_media(answer["file_unique_id"])
+        file_id = cached[0] if cached else answer["file_id"]
+        return f"send_{answer['media_type']}", {answer["media_type"]: file_id, "caption": body, "parse_mode": ParseMode.HTML}
+
+canned = CannedAnswers(CANNED_SUGGESTIONS, CANNED_MIN_SCORE)
+
+def canned_markup(names, per_row=1):
+    # Names saved before CANNED_NAME was ASCII-only may not fit in callback_data; one bad button fails the whole message
+    names = [name for name in names if len(f"cn:{name}".encode()) <= 64][:CANNED_PICKER_MAX]
+    buttons = [InlineKeyboardButton(f"💡 {name}", callback_data=f"cn:{name}") for name in names]
+    return InlineKeyboardMarkup([buttons[i:i + per_row] for i in range(0, len(buttons), per_row)])
+
+# --------------------------------------------------------------------------------
+# 📢 BROADCAST ENGINE (Rate-limited + Resumable)
+# --------------------------------------------------------------------------------
+class RateLimiter:
+    """Global token spacing plus a minimum interval per chat. Paused on flood-wait."""
+    def __init__(self, rate_per_sec, per_chat_interval):
+        self.interval = 1.0 / rate_per_sec
+        self.per_chat_interval = per_chat_interval
+        self.lock = asyncio.Lock()
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.chat_next = {}
+
+    async def acquire(self, chat_id):
+        async with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot, self.paused_until, self.chat_next.get(chat_id, 0.0))
+            self.next_slot = slot + self.interval
+            self.chat_next[chat_id] = slot + self.per_chat_interval
+            if len(self.chat_next) > 10000:
+                self.chat_next = {k: v for k, v in self.chat_next.items() if v > now}
+        delay = slot - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        # 429 from Telegram applies to the whole bot, so every sender backs off
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class BroadcastEngine:
+    def __init__(self, limiter, concurrency, max_retries, progress_interval):
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.tasks = {}
+
+    def start(self, bot, broadcast_id):
+        task = asyncio.create_task(self.run(bot, broadcast_id))
+        self.tasks[broadcast_id] = task
+
+        def _done(task):
+            self.tasks.pop(broadcast_id, None)
+            if not task.cancelled() and task.exception():
+                logger.error(f"Broadcast #{broadcast_id} crashed", exc_info=task.exception())
+        task.add_done_callback(_done)
+
+    async def resume_unfinished(self, bot):
+        for broadcast_id, status in await get_unfinished_broadcasts():
+            if broadcast_id not in self.tasks:
+                logger.info(f"Resuming broadcast #{broadcast_id}")
+                if status == "PREPARING":
+                    await snapshot_audience(broadcast_id)
+                self.start(bot, broadcast_id)
+
+    async def shutdown(self):
+        # Undelivered rows stay PENDING, so the next start picks them up again
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def run(self, bot, broadcast_id):
+        info = await get_broadcast(broadcast_id)
+        if not info: return
+        text, status_chat_id, status_message_id = info
+
+        counts = await get_broadcast_counts(broadcast_id)
+        stats = {"sent": counts.get("SENT", 0), "failed": counts.get("FAILED", 0), "total": sum(counts.values())}
+
+        queue = asyncio.Queue()
+        for uid in await get_pending_deliveries(broadcast_id):
+            queue.put_nowait(uid)
+
+        workers = [asyncio.create_task(self._worker(bot, broadcast_id, text, queue, stats))
+                   for _ in range(max(1, min(self.concurrency, queue.qsize())))]
+        reporter = asyncio.create_task(self._report_progress(bot, status_chat_id, status_message_id, stats))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            for w in workers: w.cancel()
+
+        await finish_broadcast(broadcast_id)
+        await self._edit_status(bot, status_chat_id, status_message_id,
+                                f"✅ Sent to {stats['sent']} users. ❌ Failed: {stats['failed']}.")
+
+    async def _worker(self, bot, broadcast_id, text, queue, stats):
+        while True:
+            try:
+                uid = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, attempts, error = await self._send_one(bot, uid, text)
+            try:
+                await mark_delivery(broadcast_id, uid, status, attempts, error)
+            except Exception as e:
+                # The row stays PENDING, so a resumed run retries it; this run carries on
+                logger.error(f"Broadcast #{broadcast_id}: could not record delivery to {uid}: {e}")
+            stats["sent" if status == "SENT" else "failed"] += 1
+
+    async def _send_one(self, bot, uid, text):
+        error = None
+        for attempt in range(1, self.max_retries + 1):
+            await self.limiter.acquire(uid)
+            try:
+                await bot.send_message(chat_id=uid, text=text, parse_mode=ParseMode.HTML)
+                return "SENT", attempt, None
+            except RetryAfter as e:
+                error = str(e)
+                self.limiter.pause(e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Blocked bot / deleted account: retrying won't help
+                return "FAILED", attempt, str(e)
+            except NetworkError as e:
+                error = str(e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                # ChatMigrated, unexpected API errors...: fail this user, not the whole run
+                return "FAILED", attempt, f"{type(e).__name__}: {e}"
+        return "FAILED", self.max_retries, error
+
+    async def _report_progress(self, bot, chat_id, message_id, stats):
+        last_text = None
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            done = stats["sent"] + stats["failed"]
+            text = f"⏳ Broadcasting... {done}/{stats['total']} (✅ {stats['sent']} ❌ {stats['failed']})"
+            if text != last_text:
+                await self._edit_status(bot, chat_id, message_id, text)
+                last_text = text
+
+    async def _edit_status(self, bot, chat_id, message_id, text):
+        if not chat_id or not message_id: return
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        except RetryAfter as e:
+            self.limiter.pause(e.retry_after)
+        except Exception as e:
+            logger.warning(f"Broadcast status edit failed: {e}")
+
+# One limiter for every sender: Telegram's limits are per bot, not per feature
+api_limiter = RateLimiter(API_RATE_PER_SEC, API_PER_CHAT_INTERVAL)
+
+broadcast_engine = BroadcastEngine(
+    api_limiter, BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES, BROADCAST_PROGRESS_INTERVAL,
+)
+
+# --------------------------------------------------------------------------------
+# 📮 OUTBOX (durable send queue + dead letters)
+# --------------------------------------------------------------------------------
+SEND_METHODS = {"send_message", "send_photo", "send_document", "send_video", "send_voice", "send_audio"}
+INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument, "audio": InputMediaAudio}
+
+class Outbox:
+    """Drains the outbox table with a pool of workers.
+
+    Jobs of one conversation go out strictly in order (a student's messages arrive in order,
+    a reply is tracked before its edit is sent); conversations are sent in parallel. Each job
+    is a kind plus a JSON payload, and the kind decides what is recorded after the send."""
+    def __init__(self, limiter, workers, max_attempts, backoff_base, backoff_max):
+        self.limiter = limiter
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bot = None
+        self.lanes = {}               # conversation -> deque of jobs
+        self.ready = asyncio.Queue()  # lanes whose head job may be attempted now
+        self.workers = []
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def start(self, bot):
+        # Jobs left over from the last run go out first, in their original order
+        self.bot = bot
+        for job in await get_outbox_jobs():
+            self._schedule(job)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self, timeout):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {self.pending} jobs queued; they resume on next start")
+        for w in self.workers: w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def drain(self):
+        await self.idle.wait()
+
+    async def enqueue(self, chat_id, kind, payload):
+        # Committed before it is scheduled, so a crash can't lose an accepted message
+        job_id = await add_outbox_job(chat_id, kind, payload)
+        self._schedule({"id": job_id, "chat_id": chat_id, "kind": kind, "payload": payload, "attempts": 0})
+        return job_id
+
+    def requeue(self, jobs):
+        for job in jobs:
+            self._schedule(job)
+
+    @staticmethod
+    def lane(job):
+        # Relays all target the admin group, so order by the student's chat instead
+        return job["payload"].get("source_chat_id", job["chat_id"])
+
+    def _schedule(self, job):
+        lane = self.lane(job)
+        jobs = self.lanes.get(lane)
+        if jobs is None:
+            jobs = self.lanes[lane] = deque()
+            self.ready.put_nowait(lane)
+        jobs.append(job)
+        self.pending += 1
+        self.idle.clear()
+
+    def _done(self, lane):
+        jobs = self.lanes[lane]
+        jobs.popleft()
+        self.pending -= 1
+        if jobs:
+            self.ready.put_nowait(lane)
+        else:
+            del self.lanes[lane]
+            if not self.pending: self.idle.set()
+
+    async def _worker(self):
+        while True:
+            lane = await self.ready.get()
+            job = self.lanes[lane][0]
+            try:
+                retry_in = await self._attempt(job)
+            except Exception as e:
+                # Usually the DB failing to record an outcome: keep the job and back off, never drop the lane
+                logger.error(f"Outbox {job['kind']} #{job['id']} failed unexpectedly: {e}")
+                retry_in = self._backoff(job)
+            if retry_in is None:
+                self._done(lane)
+            else:
+                # The lane stays blocked until its head job is retried, keeping the order
+                asyncio.get_running_loop().call_later(retry_in, self.ready.put_nowait, lane)
+
+    async def _attempt(self, job):
+        """Returns None once the job is finished (sent or dead-lettered), else seconds until retry."""
+        await self.limiter.acquire(job["chat_id"])
+        try:
+            result = await self._send(job)
+        except RetryAfter as e:
+            # Flood control passes by definition, so waiting it out doesn't spend the attempt budget
+            self.limiter.pause(e.retry_after)
+            return await self._retry(job, str(e), e.retry_after, counted=False)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                await self._dead(job, str(e))
+                return None
+            result = None  # an edit that changes nothing has nothing left to do
+        except Forbidden as e:
+            # Blocked bot / deleted account: retrying won't help
+            await self._dead(job, str(e))
+            return None
+        except NetworkError as e:
+            return await self._retry(job, str(e), self._backoff(job))
+        except TelegramError as e:
+            # ChatMigrated and other API refusals: the same request won't succeed later
+            await self._dead(job, f"{type(e).__name__}: {e}")
+            return None
+        except Exception as e:
+            # Not from Telegram (e.g. a DB read in _send): transient until proven otherwise
+            return await self._retry(job, f"{type(e).__name__}: {e}", self._backoff(job))
+
+        await delete_outbox_job(job["id"])
+        metrics.inc("bot_outbox_sent_total", {"kind": job["kind"]})
+        try:
+            await self._record(job, result)
+        except Exception as e:
+            # Already delivered; resending would duplicate the message
+            logger.error(f"Outbox {job['kind']} #{job['id']} sent but not recorded: {e}")
+        return None
+
+    def _backoff(self, job):
+        delay = min(self.backoff_base * 2 ** job["attempts"], self.backoff_max)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _retry(self, job, error, delay, counted=True):
+        if counted and job["attempts"] + 1 >= self.max_attempts:
+            await self._dead(job, error)  # counts this final attempt
+            return None
+        job["attempts"] += counted
+        metrics.inc("bot_outbox_retries_total", {"kind": job["kind"]})
+        await record_outbox_attempt(job["id"], job["attempts"], error)
+        return delay
+
+    async def _dead(self, job, error):
+        dead_id = await dead_letter_job(job["id"], job["attempts"] + 1, error)
+        metrics.inc("bot_outbox_dead_total", {"kind": job["kind"]})
+        logger.error(f"Outbox {job['kind']} to {job['chat_id']} dead-lettered as #{dead_id}: {error}")
+        # Edits are best effort; a lost reply or student question needs an admin to notice it
+        if job["kind"] == "reply":
+            notice = "❌ Failed"
+        elif job["kind"] in ("relay", "album"):
+            notice = f"❌ Failed to relay a question from {job['payload']['user_name']} ({job['payload']['display_id']})"
+        else:
+            return
+        try:
+            await self.bot.send_message(chat_id=ADMIN_GROUP_ID, text=f"{notice}: {error}\n↩️ /replay {dead_id}")
+        except Exception as e:
+            logger.warning(f"Dead-letter notice failed: {e}")
+
+    async def _send(self, job):
+        bot, chat_id, p = self.bot, job["chat_id"], job["payload"]
+        if job["kind"] == "album":
+            media = [INPUT_MEDIA[m["type"]](m["media"], caption=m.get("caption"), parse_mode=m.get("parse_mode"))
+                     for m in p["media"]]
+            sent = []
+            for start in range(0, len(media), ALBUM_MAX_ITEMS):
+                sent += await bot.send_media_group(chat_id=chat_id, media=media[start:start + ALBUM_MAX_ITEMS])
+            return sent
+        if job["kind"] == "edit":
+            # Looked up at send time: the reply it edits may have been queued just before it
+            tracking = await get_reply_tracking(p["admin_msg_id"])
+            if not tracking: return None
+            _, sent_msg_id, _, _ = tracking
+            if "text" in p:
+                return await bot.edit_message_text(chat_id=chat_id, message_id=sent_msg_id, text=p["text"], parse_mode=ParseMode.HTML)
+            return await bot.edit_message_caption(chat_id=chat_id, message_id=sent_msg_id, caption=p["caption"], parse_mode=ParseMode.HTML)
+        if p["method"] not in SEND_METHODS:
+            raise BadRequest(f"Unsupported outbox method {p['method']}")
+        params = p["params"]
+        if p.get("suggestions"):
+            params = dict(params, reply_markup=canned_markup(p["suggestions"]))
+        return await getattr(bot, p["method"])(chat_id=chat_id, **params)
+
+    async def _record(self, job, result):
+        p = job["payload"]
+        if job["kind"] == "relay":
+            ticket_id = await save_message(result.message_id, p["user_id"], p["user_name"], p["display_id"], p["question"])
+            if p.get("attachments"): await index_media(p["attachments"], ticket_id=ticket_id)
+            await self._react(p["source_chat_id"], p["source_message_id"])
+        elif job["kind"] == "album":
+            ticket_id = await save_album([m.message_id for m in result], p["user_id"], p["user_name"], p["display_id"], p["question"])
+            if p.get("attachments"): await index_media(p["attachments"], ticket_id=ticket_id)
+            await self._react(p["source_chat_id"], p["source_message_id"])
+        elif job["kind"] == "reply":
+            await update_message_answer(p["ticket_msg_id"], p["answer"], p["admin_name"])
+            if p.get("attachments"): await index_media(p["attachments"], answered_msg_id=p["ticket_msg_id"])
+            # Canned answers sent from a button have no admin message to track or react to
+            if p["admin_msg_id"] is not None:
+                await save_reply_tracking(p["admin_msg_id"], job["chat_id"], result.message_id, p["admin_name"], p["user_name"])
+                await self._react(ADMIN_GROUP_ID, p["admin_msg_id"])
+
+    async def _react(self, chat_id, message_id):
+        try: await self.bot.set_message_reaction(chat_id=chat_id, message_id=message_id, reaction=[ReactionTypeEmoji("❤")])
+        except: pass
+
+outbox = Outbox(api_limiter, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX)
+
+# --------------------------------------------------------------------------------
+# 🖼️ ALBUM BUFFER (media_group_id -> one sendMediaGroup)
+# --------------------------------------------------------------------------------
+class AlbumBuffer:
+    """Collects updates that share a media_group_id and flushes them once the album goes quiet."""
+    def __init__(self, window):
+        self.window = window
+        self.albums = {}   # (user_id, media_group_id) -> {"messages", "flush", "task"}
+        self.flushing = {} # user_id -> flush tasks past their quiet window
+        self.tasks = set()
+
+    def add(self, key, message, flush):
+        album = self.albums.get(key)
+        if album is None:
+            album = self.albums[key] = {"messages": [], "flush": flush, "task": None}
+        else:
+            album["task"].cancel()  # debounce: wait for the album to stop growing
+        album["messages"].append(message)
+        album["task"] = task = asyncio.create_task(self._flush_later(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        album = self.albums.pop(key)
+        busy = self.flushing.setdefault(key[0], set())
+        busy.add(album["task"])
+        try:
+            await self._relay(album)
+        finally:
+            busy.discard(album["task"])
+            if not busy: self.flushing.pop(key[0], None)
+
+    async def _relay(self, album):
+        try:
+            await album["flush"](album["messages"])
+        except Exception as e:
+            logger.error(f"Album Relay Error: {e}")
+
+    async def drain(self):
+        # Waits for every buffered album to be flushed
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    async def flush_user(self, user_id):
+        # A plain message must not overtake the user's album: finish flushes already under way,
+        # then relay whatever is still waiting out its window
+        if user_id in self.flushing:
+            await asyncio.gather(*list(self.flushing[user_id]), return_exceptions=True)
+        for key in [key for key in self.albums if key[0] == user_id]:
+            album = self.albums.pop(key)
+            album["task"].cancel()
+            await self._relay(album)
+
+    async def flush_all(self):
+        # Shutdown: relay what we have now instead of losing it
+        for key in list(self.albums):
+            album = self.albums.pop(key)
+            album["task"].cancel()
+            await self._relay(album)
+
+album_buffer = AlbumBuffer(ALBUM_WINDOW)
 
 # --------------------------------------------------------------------------------
 # ⚡ HANDLERS
 # --------------------------------------------------------------------------------
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     display_id = await get_or_create_user(user)
@@ -253,12 +2252,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply_markup=reply_markup
     )
 
+@instrumented
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     if query.data == "btn_support":
         await query.message.reply_html(LANG["contact_intro"])
 
+@instrumented
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_chat.id == ADMIN_GROUP_ID: return
     if update.message.text and update.message.text.upper() == "CLEAR":
@@ -267,40 +2268,75 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user = update.effective_user
     display_id = await get_or_create_user(user)
+
+    if update.message.media_group_id:
+        # Album item: buffer it, the whole album is relayed as one ticket
+        album_buffer.add((user.id, update.message.media_group_id), update.message,
+                         lambda messages: relay_album(user, display_id, messages))
+        return
+    await album_buffer.flush_user(user.id)
+
     question_content = update.message.text or "[Media/File]"
-    
-    # Send typing action to show user the bot is working
-    await context.bot.send_chat_action(chat_id=ADMIN_GROUP_ID, action=constants.ChatAction.TYPING)
+    admin_text = templates.relay_header(user.full_name)
+    msg = update.message
+    attachment = media_of(msg)
+    admin_text += await duplicate_hint([attachment] if attachment else [])
 
-    admin_text = f"👤 <b>ឈ្មោះ:</b> {user.full_name}\n───────────────\n"
+    if msg.text:
+        method, params = "send_message", {"text": admin_text + f"💬 <b>សំណួរ :</b> {msg.text}"}
+    elif msg.photo:
+        method, params = "send_photo", {"photo": msg.photo[-1].file_id, "caption": admin_text + f"🖼 <b>រូបភាព</b>\n{msg.caption or ''}"}
+    elif msg.document:
+        method, params = "send_document", {"document": msg.document.file_id, "caption": admin_text + f"📂 <b>ឯកសារ</b>\n{msg.caption or ''}"}
+    elif msg.video:
+        method, params = "send_video", {"video": msg.video.file_id, "caption": admin_text + f"🎥 <b>វីដេអូ</b>\n{msg.caption or ''}"}
+    elif msg.voice:
+        method, params = "send_voice", {"voice": msg.voice.file_id, "caption": admin_text + "🎤 <b>សំឡេង</b>"}
+    else:
+        return
+    params["parse_mode"] = ParseMode.HTML
 
-    sent_msg = None
-    try:
-        if update.message.text:
-            admin_text += f"💬 <b>សំណួរ :</b> {update.message.text}"
-            sent_msg = await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text=admin_text, parse_mode=ParseMode.HTML)
-        elif update.message.photo:
-            admin_text += f"🖼 <b>រូបភាព</b>\n{update.message.caption or ''}"
-            sent_msg = await context.bot.send_photo(chat_id=ADMIN_GROUP_ID, photo=update.message.photo[-1].file_id, caption=admin_text, parse_mode=ParseMode.HTML)
-        elif update.message.document:
-            admin_text += f"📂 <b>ឯកសារ</b>\n{update.message.caption or ''}"
-            sent_msg = await context.bot.send_document(chat_id=ADMIN_GROUP_ID, document=update.message.document.file_id, caption=admin_text, parse_mode=ParseMode.HTML)
-        elif update.message.video:
-            admin_text += f"🎥 <b>វីដេអូ</b>\n{update.message.caption or ''}"
-            sent_msg = await context.bot.send_video(chat_id=ADMIN_GROUP_ID, video=update.message.video.file_id, caption=admin_text, parse_mode=ParseMode.HTML)
-        elif update.message.voice:
-            admin_text += "🎤 <b>សំឡេង</b>"
-            sent_msg = await context.bot.send_voice(chat_id=ADMIN_GROUP_ID, voice=update.message.voice.file_id, caption=admin_text, parse_mode=ParseMode.HTML)
-
-        if sent_msg:
-            # Async Save
-            await save_message(sent_msg.message_id, user.id, user.full_name, display_id, question_content)
-            try: await update.message.set_reaction(reaction=[ReactionTypeEmoji("❤")])
-            except: pass
-            
-    except Exception as e:
-        logger.error(f"Relay Error: {e}")
+    # Queued: the outbox sends it, saves the ticket and reacts once Telegram accepts it
+    await outbox.enqueue(ADMIN_GROUP_ID, "relay", {
+        "method": method, "params": params,
+        "user_id": user.id, "user_name": user.full_name, "display_id": display_id, "question": question_content,
+        "source_chat_id": msg.chat_id, "source_message_id": msg.message_id,
+        "attachments": [attachment] if attachment else [],
+        "suggestions": canned.suggest(msg.text or msg.caption),
+    })
 
+async def duplicate_hint(attachments):
+    # Points admins at the ticket where this exact file was first seen
+    for attachment in attachments:
+        cached = await get_cached_media(attachment["unique_id"])
+        if cached and cached[3]:
+            return f"♻️ <i>Duplicate of ticket #{cached[3]}</i>\n"
+    return ""
+
+async def relay_album(user, display_id, messages):
+    messages = sorted(messages, key=lambda m: m.message_id)
+    caption = next((m.caption for m in messages if m.caption), "")
+    attachments = [a for a in map(media_of, messages) if a]
+    hint = await duplicate_hint(attachments)
+    admin_text = f"{templates.relay_header(user.full_name)}{hint}🖼 <b>អាល់ប៊ុម ({len(messages)})</b>\n{caption}"
+
+    media = []
+    for m in messages:
+        extra = {} if media else {"caption": admin_text, "parse_mode": ParseMode.HTML}
+        if m.photo: media.append({"type": "photo", "media": m.photo[-1].file_id, **extra})
+        elif m.video: media.append({"type": "video", "media": m.video.file_id, **extra})
+        elif m.document: media.append({"type": "document", "media": m.document.file_id, **extra})
+        elif m.audio: media.append({"type": "audio", "media": m.audio.file_id, **extra})
+    if not media: return
+
+    await outbox.enqueue(ADMIN_GROUP_ID, "album", {
+        "media": media,
+        "user_id": user.id, "user_name": user.full_name, "display_id": display_id, "question": caption or "[Album]",
+        "source_chat_id": messages[0].chat_id, "source_message_id": messages[0].message_id,
+        "attachments": attachments,
+    })
+
+@instrumented
 async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_chat.id != ADMIN_GROUP_ID or not update.message.reply_to_message: return 
 
@@ -309,44 +2345,36 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if mapping:
         user_id, user_name, display_id = mapping
         admin_name = update.effective_user.full_name or "Support Agent"
-        
-        sent_user_msg = None
-        try:
-            header = f"{LANG['reply_header']}\n───────────────\n"
-            footer = LANG["reply_footer"].format(name=user_name)
-            admin_label = f"<b>ឆ្លើយតប :</b> "
-
-            if update.message.text:
-                full_text = f"{header}{admin_label}{update.message.text}{footer}"
-                sent_user_msg = await context.bot.send_message(chat_id=user_id, text=full_text, parse_mode=ParseMode.HTML)
-            elif update.message.photo:
-                caption = f"{header}{admin_label}{update.message.caption or ''}{footer}"
-                sent_user_msg = await context.bot.send_photo(chat_id=user_id, photo=update.message.photo[-1].file_id, caption=caption, parse_mode=ParseMode.HTML)
-            elif update.message.document:
-                caption = f"{header}{admin_label}{update.message.caption or ''}{footer}"
-                sent_user_msg = await context.bot.send_document(chat_id=user_id, document=update.message.document.file_id, caption=caption, parse_mode=ParseMode.HTML)
-            elif update.message.video:
-                caption = f"{header}{admin_label}{update.message.caption or ''}{footer}"
-                sent_user_msg = await context.bot.send_video(chat_id=user_id, video=update.message.video.file_id, caption=caption, parse_mode=ParseMode.HTML)
-            elif update.message.voice:
-                caption = f"{header}{admin_label}(Voice Message){footer}"
-                sent_user_msg = await context.bot.send_voice(chat_id=user_id, voice=update.message.voice.file_id, caption=caption, parse_mode=ParseMode.HTML)
-
-            # DB Operations
-            await update_message_answer(update.message.reply_to_message.message_id, update.message.text or "[Media]", admin_name)
-            
-            try: await update.message.set_reaction(reaction=[ReactionTypeEmoji("❤")])
-            except: pass
-            
-            if sent_user_msg:
-                await save_reply_tracking(update.message.message_id, user_id, sent_user_msg.message_id, admin_name, user_name)
+        msg = update.message
+        attachment = media_of(msg)
 
-        except Exception as e:
-            await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text=f"❌ Failed: {e}")
+        if msg.text:
+            method, params = "send_message", {"text": templates.reply(msg.text, user_name)}
+        elif msg.photo:
+            method, params = "send_photo", {"photo": msg.photo[-1].file_id, "caption": templates.reply(msg.caption or '', user_name)}
+        elif msg.document:
+            method, params = "send_document", {"document": msg.document.file_id, "caption": templates.reply(msg.caption or '', user_name)}
+        elif msg.video:
+            method, params = "send_video", {"video": msg.video.file_id, "caption": templates.reply(msg.caption or '', user_name)}
+        elif msg.voice:
+            method, params = "send_voice", {"voice": msg.voice.file_id, "caption": templates.reply("(Voice Message)", user_name)}
+        else:
+            await update_message_answer(msg.reply_to_message.message_id, msg.text or "[Media]", admin_name)
+            return
+        params["parse_mode"] = ParseMode.HTML
+
+        # Failures land in dead_letters and are reported to the group with a /replay hint
+        await outbox.enqueue(user_id, "reply", {
+            "method": method, "params": params,
+            "ticket_msg_id": msg.reply_to_message.message_id, "admin_msg_id": msg.message_id,
+            "admin_name": admin_name, "user_name": user_name, "answer": msg.text or "[Media]",
+            "attachments": [attachment] if attachment else [],
+        })
     else:
         if not update.message.text.startswith("/"):
             await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text="⚠️ Ticket context lost.")
 
+@instrumented
 async def handle_admin_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_chat.id != ADMIN_GROUP_ID: return
     edited_msg = update.edited_message
@@ -354,19 +2382,93 @@ async def handle_admin_edit(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     tracking = await get_reply_tracking(edited_msg.message_id)
     if tracking:
-        user_chat_id, sent_msg_id, admin_name, user_name = tracking
-        try:
-            header = f"{LANG['reply_header']}\n───────────────\n"
-            footer = LANG["reply_footer"].format(name=user_name)
-            admin_label = f"<b>ឆ្លើយតប :</b> "
-            
-            if edited_msg.text:
-                await context.bot.edit_message_text(chat_id=user_chat_id, message_id=sent_msg_id, text=f"{header}{admin_label}{edited_msg.text}{footer}", parse_mode=ParseMode.HTML)
-            elif edited_msg.caption:
-                await context.bot.edit_message_caption(chat_id=user_chat_id, message_id=sent_msg_id, caption=f"{header}{admin_label}{edited_msg.caption}{footer}", parse_mode=ParseMode.HTML)
-        except Exception:
-            pass
+        user_chat_id, _, _, user_name = tracking
+    elif edited_msg.reply_to_message:
+        # The reply may still be waiting in the outbox; the edit queues behind it
+        mapping = await get_message_context(edited_msg.reply_to_message.message_id)
+        if not mapping: return
+        user_chat_id, user_name, _ = mapping
+    else:
+        return
+
+    if edited_msg.text:
+        payload = {"admin_msg_id": edited_msg.message_id, "text": templates.reply(edited_msg.text, user_name)}
+    elif edited_msg.caption:
+        payload = {"admin_msg_id": edited_msg.message_id, "caption": templates.reply(edited_msg.caption, user_name)}
+    else:
+        return
+    await outbox.enqueue(user_chat_id, "edit", payload)
+
+# Paging state lives server-side: callback_data is capped at 64 bytes
+search_sessions = LRUCache(1000, CACHE_TTL)  # token -> {"kind", "arg", "cursors"}
+
+def _short(text, limit=120):
+    text = (text or "").replace("\n", " ")
+    return html.escape(text if len(text) <= limit else text[:limit] + "…")
 
+async def render_ticket_page(token, page):
+    session = search_sessions.get(token)
+    if session is None:
+        return "⌛ Search expired, please run it again.", None
+    fetch = search_tickets if session["kind"] == "search" else get_ticket_history
+    # Keyset pagination: each page starts below the last id of the previous one
+    rows = await fetch(session["arg"], session["cursors"][page], SEARCH_PAGE_SIZE + 1)
+    has_next = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if has_next and len(session["cursors"]) == page + 1:
+        session["cursors"].append(rows[-1][0])
+
+    icon = "🔎" if session["kind"] == "search" else "📜"
+    lines = [f"{icon} <b>{html.escape(session['arg'])}</b> — page {page + 1}", "───────────────"]
+    if not rows:
+        lines.append("📭 No tickets found.")
+    for ticket_id, display_id, user_name, question, answer, status in rows:
+        mark = "✅" if status == "SOLVED" else "⏳"
+        lines.append(f"{mark} <b>#{ticket_id}</b> • <code>{display_id or '-'}</code> • {html.escape(user_name or '')}")
+        lines.append(f"❓ {_short(question)}")
+        if answer:
+            lines.append(f"💬 {_short(answer)}")
+        lines.append("")
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"pg:{token}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"pg:{token}:{page + 1}"))
+    return "\n".join(lines).strip(), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def start_ticket_listing(update, kind, arg):
+    token = secrets.token_urlsafe(6)
+    search_sessions.set(token, {"kind": kind, "arg": arg, "cursors": [2 ** 62]})
+    text, markup = await render_ticket_page(token, 0)
+    await update.message.reply_html(text, reply_markup=markup)
+
+@instrumented
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != ADMIN_GROUP_ID: return
+    text = " ".join(context.args).strip()
+    if len(text) < SEARCH_MIN_CHARS:
+        await update.message.reply_html(f"Usage: <code>/search [text]</code> (at least {SEARCH_MIN_CHARS} characters)")
+        return
+    await start_ticket_listing(update, "search", text)
+
+@instrumented
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != ADMIN_GROUP_ID: return
+    if not context.args:
+        await update.message.reply_html("Usage: <code>/history DI-001</code>")
+        return
+    await start_ticket_listing(update, "history", context.args[0].upper())
+
+@instrumented
+async def ticket_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    _, token, page = query.data.split(":")
+    text, markup = await render_ticket_page(token, int(page))
+    await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@instrumented
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_chat.id != ADMIN_GROUP_ID: return
     msg = " ".join(context.args)
@@ -374,28 +2476,135 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage: /broadcast [Message]")
         return
     
-    users = await get_all_users_details()
-    count = 0
     formatted = f"{LANG['broadcast_header']}\n───────────────\n{msg}"
-    
-    status = await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text=f"⏳ Sending to {len(users)} users...")
-    for (uid,) in users:
-        try:
-            await context.bot.send_message(chat_id=uid, text=formatted, parse_mode=ParseMode.HTML)
-            count += 1
-        except: pass
-    await context.bot.edit_message_text(chat_id=ADMIN_GROUP_ID, message_id=status.message_id, text=f"✅ Sent to {count} users.")
 
+    status = await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text="⏳ Preparing broadcast...")
+    broadcast_id = await create_broadcast(formatted, ADMIN_GROUP_ID, status.message_id)
+    # Runs in the background so the handler returns immediately
+    broadcast_engine.start(context.bot, broadcast_id)
+
+@instrumented
+async def dead_letters_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != ADMIN_GROUP_ID: return
+    rows = await get_dead_letters(DEAD_LETTER_PAGE_SIZE)
+    if not rows:
+        await update.message.reply_html("📭 No failed messages.")
+        return
+    lines = ["☠️ <b>Failed messages</b>", "───────────────"]
+    for dead_id, chat_id, kind, attempts, error, failed_at in rows:
+        lines.append(f"<b>#{dead_id}</b> • {kind} → <code>{chat_id}</code> • {attempts}x • {str(failed_at)[:16]}")
+        lines.append(f"⚠️ {_short(error)}")
+    lines.append("\n↩️ <code>/replay [id]</code> or <code>/replay all</code>")
+    await update.message.reply_html("\n".join(lines))
+
+@instrumented
+async def replay_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != ADMIN_GROUP_ID: return
+    arg = context.args[0].lstrip("#").lower() if context.args else ""
+    if arg != "all" and not arg.isdigit():
+        await update.message.reply_html("Usage: <code>/replay [id]</code> or <code>/replay all</code>")
+        return
+    jobs = await requeue_dead_letters(None if arg == "all" else int(arg))
+    outbox.requeue(jobs)
+    await update.message.reply_html(f"↩️ Re-queued {len(jobs)} message(s).")
+
+@instrumented
+async def canned_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_chat.id != ADMIN_GROUP_ID: return
+    msg = update.message
+    sub = context.args[0].lower() if context.args else ""
+    usage = ("Usage:\n<code>/canned</code> (as a reply to a ticket) : pick an answer\n"
+             "<code>/canned add [name] [text]</code> : save, reply to a file to attach it\n"
+             "<code>/canned del [name]</code> : remove")
+
+    if sub == "add":
+        parts = msg.text.split(None, 3)  # keeps the answer's own line breaks
+        name = parts[2] if len(parts) > 2 else ""
+        text = parts[3] if len(parts) > 3 else ""
+        attachment = media_of(msg.reply_to_message) if msg.reply_to_message else None
+        if not CANNED_NAME.fullmatch(name) or not (text or attachment):
+            await msg.reply_html(usage)
+            return
+        if attachment:
+            await index_media([attachment])  # cached, so sending it later needs no upload
+        answer = {"name": name, "text": text, "media_type": attachment and attachment["type"],
+                  "file_unique_id": attachment and attachment["unique_id"], "file_id": attachment and attachment["file_id"]}
+        await canned.put(answer, update.effective_user.full_name)
+        await msg.reply_html(f"✅ Saved canned answer <b>{html.escape(name)}</b>.")
+    elif sub in ("del", "delete") and len(context.args) == 2:
+        removed = await canned.delete(context.args[1])
+        await msg.reply_html("🗑 Removed." if removed else "⚠️ No such canned answer.")
+    elif not canned.answers:
+        await msg.reply_html(f"📭 No canned answers yet.\n\n{usage}")
+    elif not msg.reply_to_message or not await get_message_context(msg.reply_to_message.message_id):
+        names = ", ".join(f"<code>{html.escape(name)}</code>" for name in sorted(canned.answers))
+        await msg.reply_html(f"💬 <b>Canned answers ({len(canned.answers)})</b>: {names}\n\n"
+                             f"↩️ Reply to a ticket with <code>/canned</code> to send one.\n\n{usage}")
+    else:
+        # Posted as a reply to the ticket itself (Telegram doesn't nest reply_to_message),
+        # so the button handler finds the ticket one level up
+        more = f", first {CANNED_PICKER_MAX} shown" if len(canned.answers) > CANNED_PICKER_MAX else ""
+        await msg.reply_to_message.reply_html(f"💬 <b>Canned answers ({len(canned.answers)}{more})</b>",
+                                              reply_markup=canned_markup(sorted(canned.answers), per_row=2))
+
+@instrumented
+async def canned_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query.message.chat_id != ADMIN_GROUP_ID:
+        await query.answer()
+        return
+    answer = canned.answers.get(query.data.split(":", 1)[1])
+
+    # Suggestion buttons sit on the ticket itself; the /canned list is a reply to the ticket
+    ticket_msg_id = query.message.message_id
+    mapping = await get_message_context(ticket_msg_id)
+    if not mapping and query.message.reply_to_message:
+        ticket_msg_id = query.message.reply_to_message.message_id
+        mapping = await get_message_context(ticket_msg_id)
+    if not answer or not mapping:
+        await query.answer("⚠️ Reply to a ticket with /canned to send an answer." if answer else "⚠️ Canned answer not found.",
+                           show_alert=True)
+        return
+
+    user_id, user_name, _ = mapping
+    method, params = await canned.reply_params(answer, user_name)
+    await outbox.enqueue(user_id, "reply", {
+        "method": method, "params": params,
+        "ticket_msg_id": ticket_msg_id, "admin_msg_id": None,
+        "admin_name": query.from_user.full_name or "Support Agent", "user_name": user_name,
+        "answer": answer["text"] or f"[{answer['media_type']}]",
+    })
+    await query.answer(f"✅ {answer['name']} → {user_name}")
+
+@instrumented
 async def admin_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_chat.id != ADMIN_GROUP_ID: return
     await update.message.reply_html(LANG["admin_help_text"])
 
 async def post_init(application: Application) -> None:
+    bot_state["application"] = application
+    asyncio.get_running_loop().set_default_executor(io_executor)
+    await web_server.start()
     await application.bot.set_my_commands([
         BotCommand("start", "Start Menu"),
         BotCommand("help", "Help"),
         BotCommand("clear", "End Chat")
     ])
+    await canned.load()
+    await outbox.start(application.bot)
+    await broadcast_engine.resume_unfinished(application.bot)
+
+async def post_stop(application: Application) -> None:
+    # Bot is still usable here (unlike post_shutdown), so buffered albums and queued sends can still go out
+    await album_buffer.flush_all()
+    await outbox.stop(OUTBOX_DRAIN_TIMEOUT)
+
+async def post_shutdown(application: Application) -> None:
+    await web_server.stop()
+    await broadcast_engine.shutdown()
+    # Flush queued writes before the process exits
+    await asyncio.to_thread(storage.close)
+    await asyncio.to_thread(db.close)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -403,16 +2612,30 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 # --------------------------------------------------------------------------------
 # 🚀 MAIN
 # --------------------------------------------------------------------------------
-def main() -> None:
-    threading.Thread(target=start_web_server, daemon=True).start()
-    threading.Thread(target=auto_cleanup_task, daemon=True).start()
-
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+def build_application(webhook=False) -> Application:
+    builder = (
+        Application.builder().token(BOT_TOKEN).base_url(BOT_API_BASE_URL)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAX))
+        .concurrent_updates(update_processor)
+        .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    )
+    if webhook:
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("help", admin_help_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("deadletters", dead_letters_command))
+    application.add_handler(CommandHandler("replay", replay_command))
+    application.add_handler(CommandHandler("canned", canned_command))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("clear", start))
+    application.add_handler(CallbackQueryHandler(ticket_page_handler, pattern=r"^pg:"))
+    application.add_handler(CallbackQueryHandler(canned_button_handler, pattern=r"^cn:"))
     application.add_handler(CallbackQueryHandler(button_handler))
 
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND & (filters.TEXT | filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.VOICE), handle_user_message))
@@ -420,9 +2643,17 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.Chat(chat_id=ADMIN_GROUP_ID) & filters.UpdateType.EDITED_MESSAGE, handle_admin_edit))
 
     application.add_error_handler(error_handler)
+    return application
+
+def main() -> None:
+    threading.Thread(target=auto_cleanup_task, daemon=True).start()
+    application = build_application(webhook=bool(WEBHOOK_URL))
 
     print("🚀 Enterprise Infinity Bot v18 (Turbo + WAL Mode) is ONLINE...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
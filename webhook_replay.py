@@ -0,0 +1,92 @@
+"""Replays recorded Telegram updates against the bot's webhook endpoint.
+
+Usage:
+    python webhook_replay.py updates.jsonl --url http://127.0.0.1:8080/telegram/webhook --concurrency 20
+
+The input file is either a JSON list of updates or one update per line (JSONL).
+Reports accepted/rejected counts, updates/sec and POST latency percentiles.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import httpx
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def replay(updates, url, secret, concurrency, repeat):
+    queue = asyncio.Queue()
+    for i in range(repeat):
+        for update in updates:
+            # Fresh update_id per copy so the bot treats repeats as new updates
+            queue.put_nowait(dict(update, update_id=update.get("update_id", 0) + i * len(updates)))
+
+    latencies, statuses = [], {}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+
+    async def worker(client):
+        while True:
+            try:
+                update = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                resp = await client.post(url, json=update, headers=headers)
+                status = resp.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    total = len(latencies)
+    print(f"📦 Sent {total} updates in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} updates/sec)")
+    print(f"📊 Status codes: {statuses}")
+    print(f"⏱️ Latency p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms max={max(latencies, default=0) * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="recorded updates (JSON list or JSONL)")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('PORT', 8080)}/telegram/webhook")
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET"),
+                        help="defaults to WEBHOOK_SECRET, or the secret the bot derives from BOT_TOKEN")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="replay the file this many times")
+    args = parser.parse_args()
+
+    secret = args.secret
+    if not secret:
+        # Same derivation as the bot; computed here so the load client never opens the bot's database
+        token = os.environ.get("BOT_TOKEN")
+        if not token:
+            parser.error("pass --secret, or set WEBHOOK_SECRET or BOT_TOKEN")
+        secret = hashlib.sha256(token.encode()).hexdigest()
+    asyncio.run(replay(load_updates(args.file), args.url, secret, args.concurrency, args.repeat))
+
+
+if __name__ == "__main__":
+    main()